@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from api.middleware import install_query_counter
+        from api.sharding import reserve_id_ranges
+        post_migrate.connect(reserve_id_ranges, sender=self)
+        connection_created.connect(install_query_counter)
@@ -0,0 +1,170 @@
+"""
+Async variants of the note and label endpoints for the ASGI application
+(core.asgi), mounted under /api/async/. Note reads and cache writes go
+through AsyncNoteCache on the asyncio Redis client; Django 4.0 has no
+async ORM, so database work runs in worker threads via sync_to_async.
+"""
+import asyncio
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.http import Http404, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.request import Request
+
+from api.authentication import authenticate_token
+from api.cache import AsyncNoteCache, DataVersion, NoteCache
+from api.models import Label, Note
+from api.pagination import KeysetPagination
+from api.serializers import LabelSerializer, NoteSerializer
+from api.sharding import UserMoving, check_writable
+from api.utils import note_list_filters, str_to_bool
+
+logger = logging.getLogger(__name__)
+
+
+def JsonReturnResponse(message="", data=None, status_code=status.HTTP_200_OK, **extra):
+    """Same envelope as ReturnResponse for plain Django views"""
+    if not data:
+        data = {}
+    return JsonResponse({'status': status_code, 'message': message, 'data': data, **extra}, status=status_code)
+
+
+def save_serializer(serializer, **kwargs):
+    """Validate and save, return the instance and its representation"""
+    serializer.is_valid(raise_exception=True)
+    instance = serializer.save(**kwargs)
+    return instance, serializer.data
+
+
+class AsyncAPIView(View):
+    """Authenticate the bearer token and wrap errors in the response envelope"""
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Django 4.0 only runs function views as coroutines, mark the view like 4.1 does
+        view = super().as_view(**initkwargs)
+        view._is_coroutine = asyncio.coroutines._is_coroutine
+        return csrf_exempt(view)
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            request.user = await self.authenticate(request)
+            if request.method not in SAFE_METHODS:
+                await sync_to_async(check_writable)(request.user.id)
+            response = super().dispatch(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+        except AuthenticationFailed as e:
+            return JsonReturnResponse(message=str(e.detail), status_code=status.HTTP_401_UNAUTHORIZED)
+        except UserMoving as e:
+            return JsonReturnResponse(message=str(e.detail), status_code=e.status_code)
+        except Http404 as e:
+            return JsonReturnResponse(message=str(e), status_code=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.exception(e)
+            return JsonReturnResponse(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+
+    @staticmethod
+    async def authenticate(request):
+        prefix, _, token = request.headers.get('Authorization', '').partition(' ')
+        if not token:
+            raise AuthenticationFailed('Authentication credentials were not provided.')
+        return await sync_to_async(authenticate_token)(token)
+
+    @staticmethod
+    def get_data(request):
+        return json.loads(request.body or b'{}')
+
+
+class AsyncNoteListView(AsyncAPIView):
+
+    async def get(self, request):
+        paginator = KeysetPagination()
+        filters = note_list_filters(request.GET)
+        data = await paginator.apaginate_cache(AsyncNoteCache(request.user.id), Request(request), **filters)
+        if data:
+            return JsonReturnResponse(data=data, next=paginator.get_next_link())
+        return JsonReturnResponse(message="No data found", status_code=status.HTTP_204_NO_CONTENT)
+
+    async def post(self, request):
+        serializer = NoteSerializer(data=dict(self.get_data(request), user=request.user.id))
+        note, data = await sync_to_async(save_serializer)(serializer)
+        await AsyncNoteCache(request.user.id).set(note)
+        return JsonReturnResponse(data=data, status_code=status.HTTP_201_CREATED)
+
+
+class AsyncNoteDetailView(AsyncAPIView):
+
+    async def get(self, request, pk):
+        data = await AsyncNoteCache(request.user.id).get(pk)
+        if data is None:
+            return JsonReturnResponse(status_code=status.HTTP_404_NOT_FOUND)
+        return JsonReturnResponse(data=data)
+
+    async def put(self, request, pk):
+        note = await sync_to_async(get_object_or_404)(Note.objects.for_user(request.user.id), pk=pk)
+        serializer = NoteSerializer(note, data=dict(self.get_data(request), user=request.user.id))
+        note, data = await sync_to_async(save_serializer)(serializer)
+        await AsyncNoteCache(request.user.id).set(note)
+        return JsonReturnResponse(data=data)
+
+    async def delete(self, request, pk):
+        note = await sync_to_async(get_object_or_404)(Note.objects.for_user(request.user.id), pk=pk)
+        await sync_to_async(note.delete)()
+        await AsyncNoteCache(request.user.id).delete(pk)
+        return JsonReturnResponse(message='Delete successful', status_code=status.HTTP_204_NO_CONTENT)
+
+
+class AsyncLabelListView(AsyncAPIView):
+
+    async def get(self, request):
+        paginator = KeysetPagination()
+
+        def fetch():
+            queryset = Label.objects.for_user(request.user.id)
+            archived = str_to_bool(request.GET.get('archived'))
+            if archived is not None:
+                queryset = queryset.filter(is_archived=archived)
+            return LabelSerializer(paginator.paginate_queryset(queryset, Request(request)), many=True).data
+
+        data = await sync_to_async(fetch)()
+        if data:
+            return JsonReturnResponse(data=data, next=paginator.get_next_link())
+        return JsonReturnResponse(message="No data found", status_code=status.HTTP_204_NO_CONTENT)
+
+    async def post(self, request):
+        serializer = LabelSerializer(data=self.get_data(request))
+        label, data = await sync_to_async(save_serializer)(serializer, author=request.user)
+        await sync_to_async(DataVersion(request.user.id).bump)()
+        return JsonReturnResponse(data=data, status_code=status.HTTP_201_CREATED)
+
+
+class AsyncLabelDetailView(AsyncAPIView):
+
+    async def get(self, request, pk):
+        label = await sync_to_async(get_object_or_404)(Label.objects.for_user(request.user.id), pk=pk)
+        return JsonReturnResponse(data=LabelSerializer(label).data)
+
+    async def put(self, request, pk):
+        label = await sync_to_async(get_object_or_404)(Label.objects.for_user(request.user.id), pk=pk)
+        label, data = await sync_to_async(save_serializer)(LabelSerializer(label, data=self.get_data(request)))
+        await sync_to_async(DataVersion(request.user.id).bump)()
+        return JsonReturnResponse(data=data)
+
+    async def delete(self, request, pk):
+        def destroy():
+            label = get_object_or_404(Label.objects.for_user(request.user.id), pk=pk)
+            note_ids = list(label.note.values_list('id', flat=True))
+            label.delete()
+            NoteCache(request.user.id).refresh(note_ids)
+
+        await sync_to_async(destroy)()
+        return JsonReturnResponse(status_code=status.HTTP_204_NO_CONTENT)
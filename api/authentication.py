@@ -1,10 +1,44 @@
+import time
+from functools import lru_cache
+
 import jwt
 from django.conf import settings
+from django.core.cache import cache
 from rest_framework.authentication import (BaseAuthentication,
                                            get_authorization_header)
 from rest_framework.exceptions import AuthenticationFailed
 
 from api.models import User
+from api.utils import user_cache_key
+
+
+@lru_cache(maxsize=settings.AUTH_TOKEN_CACHE_SIZE)
+def verify_token(token):
+    """Decode and verify a token once, later calls are served from the LRU"""
+    return jwt.decode(token, settings.SECRET_KEY, algorithms="HS256")
+
+
+def get_user(user_id):
+    """Return the user from the short lived cache, loading it from the database on a miss"""
+    key = user_cache_key(user_id)
+    user = cache.get(key)
+    if user is None:
+        user = User.objects.get(pk=user_id)
+        cache.set(key, user, timeout=settings.AUTH_USER_CACHE_TIMEOUT)
+    return user
+
+
+def authenticate_token(token):
+    """Return the user of a valid token or raise AuthenticationFailed"""
+    try:
+        payload = verify_token(token)
+        if payload['exp'] <= time.time():
+            raise jwt.ExpiredSignatureError
+        return get_user(payload['user_id'])
+    except jwt.ExpiredSignatureError:
+        raise AuthenticationFailed('Your token is expired,login')
+    except (jwt.DecodeError, KeyError, User.DoesNotExist):
+        raise AuthenticationFailed('Your token is invalid,login')
 
 
 class JWTAuthentication(BaseAuthentication):
@@ -14,11 +48,4 @@ class JWTAuthentication(BaseAuthentication):
         if not auth_data:
             return None
         prefix, token = auth_data.decode('utf-8').split(' ')
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms="HS256")
-        try:
-            user = User.objects.get(pk=payload['user_id'])
-            return (user, token)
-        except jwt.DecodeError:
-            raise AuthenticationFailed('Your token is invalid,login')
-        except jwt.ExpiredSignatureError:
-            raise AuthenticationFailed('Your token is expired,login')
+        return (authenticate_token(token), token)
@@ -0,0 +1,458 @@
+import asyncio
+import logging
+import time
+from weakref import WeakKeyDictionary
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Prefetch
+from django.forms.models import model_to_dict
+from django_redis import get_redis_connection
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import LockError, WatchError
+
+from api.cache_serializers import get_note_cache_codec
+from api.local_cache import INVALIDATION_CHANNEL, local_cache
+from api.metrics import metrics
+from api.models import Label, Note
+from api.replicas import pin_primary, replica_reads
+
+logger = logging.getLogger(__name__)
+
+
+# asyncio clients are bound to the loop they were created in, under WSGI every async view runs in a new loop
+_async_clients = WeakKeyDictionary()
+
+
+def get_async_redis_connection():
+    """Return the asyncio client of the running loop for the Redis server of the default cache"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncRedis.from_url(settings.CACHES['default']['LOCATION'])
+    return client
+
+
+class DataVersion:
+    """
+    Per-user version of the note and label data, bumped on every write.
+    A missing counter restarts from the current time in milliseconds, so a
+    flushed Redis never hands out a version seen before.
+    """
+    key_prefix = 'version'
+
+    def __init__(self, user_id, client=None):
+        self.user_id = user_id
+        self.key = f'{self.key_prefix}:{user_id}'
+        self.client = client or get_redis_connection()
+
+    def get(self):
+        pipe = self.client.pipeline()
+        pipe.set(self.key, time.time_ns() // 1000000, nx=True)
+        pipe.get(self.key)
+        return int(pipe.execute()[-1])
+
+    def bump(self, pipe=None):
+        """
+        Increase the version, queued on ``pipe`` when given, drop the user's
+        entries from the in-process caches of every process and read the
+        user's data from the primaries for a while
+        """
+        target = pipe if pipe is not None else self.client.pipeline()
+        target.set(self.key, time.time_ns() // 1000000, nx=True)
+        target.incr(self.key)
+        target.publish(INVALIDATION_CHANNEL, self.user_id)
+        pin_primary(self.user_id, target)
+        if pipe is None:
+            target.execute()
+        local_cache.invalidate(self.user_id)
+
+
+class NoteCache:
+    """
+    Per-user note cache stored as one Redis hash, one field per note id,
+    plus sorted sets of note ids used to read the notes page by page: one
+    for all notes and one per partition, active and archived.
+    A sentinel member in every key marks a built cache, so a user without
+    notes is not mistaken for a cache miss. Reads rebuild a missing cache
+    from the database, one rebuild per user at a time.
+    Rendered list responses are kept in a separate hash of at most
+    ``rendered_max_fields`` bodies, dropped by every write of the user's notes.
+    """
+    key_prefix = 'notes'
+    sentinel = '_'
+    lock_timeout = 10
+    lock_wait = 5
+    rebuild_retries = 3
+    rendered_timeout = 300
+    rendered_max_fields = 50
+
+    def __init__(self, user_id, client=None):
+        self.user_id = user_id
+        self.key = f'{self.key_prefix}:{user_id}'
+        self.index_keys = {
+            None: f'{self.key}:ids',
+            False: f'{self.key}:ids:active',
+            True: f'{self.key}:ids:archived',
+        }
+        self.lock_key = f'{self.key}:lock'
+        self.rendered_key = f'{self.key}:rendered'
+        self.client = client or get_redis_connection()
+
+    @staticmethod
+    def to_dict(note):
+        data = model_to_dict(note)
+        data['labels'] = [label.id for label in note.labels.all()]
+        return data
+
+    @staticmethod
+    def dumps(data):
+        return get_note_cache_codec().dumps(data)
+
+    @staticmethod
+    def loads(value):
+        return get_note_cache_codec().loads(value)
+
+    def get_queryset(self):
+        labels = Prefetch('labels', queryset=Label.objects.only('id'))
+        return Note.objects.for_user(self.user_id).prefetch_related(labels)
+
+    def get(self, note_id):
+        """Return the cached note with given id or None"""
+        if local_cache.enabled:
+            return self.local().get(int(note_id))
+        pipe = self.client.pipeline()
+        pipe.hget(self.key, note_id)
+        pipe.hexists(self.key, self.sentinel)
+        value, built = pipe.execute()
+        metrics.cache_access(self.key_prefix, built)
+        if not built:
+            return self.load().get(int(note_id))
+        return None if value is None else self.loads(value)
+
+    def all(self):
+        """Return all cached notes of the user ordered by id"""
+        if local_cache.enabled:
+            return [data for note_id, data in sorted(self.local().items())]
+        dataset = self.client.hgetall(self.key)
+        metrics.cache_access(self.key_prefix, self.sentinel.encode() in dataset)
+        if self.sentinel.encode() not in dataset:
+            return [data for note_id, data in sorted(self.load().items())]
+        dataset.pop(self.sentinel.encode())
+        return [self.loads(dataset[k]) for k in sorted(dataset, key=int)]
+
+    def page(self, after=None, limit=None, archived=None, label=None, color=None):
+        """
+        Return up to ``limit`` cached notes with id greater than ``after``
+        ordered by id. ``archived`` selects a partition, filters on ``label``
+        or ``color`` read the page of ids from the database indexes.
+        """
+        if local_cache.enabled:
+            return self.select(self.local(), after, limit, archived, label, color)
+        if label is not None or color is not None:
+            return self.get_many(self.filter_ids(after, limit, archived=archived, label=label, color=color))
+        index_key = self.index_keys[archived]
+        pipe = self.client.pipeline()
+        pipe.zrangebyscore(index_key, f'({after or 0}', '+inf', start=0 if limit else None, num=limit)
+        pipe.hexists(self.key, self.sentinel)
+        pipe.zscore(index_key, self.sentinel)
+        ids, built, indexed = pipe.execute()
+        metrics.cache_access(self.key_prefix, built and indexed is not None)
+        if not built or indexed is None:
+            return self.select(self.load(), after, limit, archived)
+        if not ids:
+            return []
+        return [self.loads(value) for value in self.client.hmget(self.key, ids) if value is not None]
+
+    @staticmethod
+    def select(dataset, after=None, limit=None, archived=None, label=None, color=None):
+        """Page through notes by id in memory, used when the cache is not built or held in process"""
+        ids = sorted(
+            note_id for note_id, data in dataset.items()
+            if note_id > (after or 0) and archived in (None, data['is_archived'])
+            and (label is None or label in data['labels']) and color in (None, data['color'])
+        )[:limit]
+        return [dataset[note_id] for note_id in ids]
+
+    def filter_ids(self, after=None, limit=None, archived=None, label=None, color=None):
+        """Return a page of note ids matching the filters, read from the database indexes"""
+        queryset = Note.objects.for_user(self.user_id)
+        if archived is not None:
+            queryset = queryset.filter(is_archived=archived)
+        if label is not None:
+            queryset = queryset.filter(labels__id=label)
+        if color is not None:
+            queryset = queryset.filter(color=color)
+        if after is not None:
+            queryset = queryset.filter(pk__gt=after)
+        return list(queryset.order_by('pk').values_list('pk', flat=True)[:limit])
+
+    def get_many(self, note_ids):
+        """Return the cached notes with given ids in the same order, skipping unknown ids"""
+        if not note_ids:
+            return []
+        if local_cache.enabled:
+            dataset = self.local()
+            return [dataset[note_id] for note_id in note_ids if note_id in dataset]
+        pipe = self.client.pipeline()
+        pipe.hmget(self.key, note_ids)
+        pipe.hexists(self.key, self.sentinel)
+        values, built = pipe.execute()
+        metrics.cache_access(self.key_prefix, built)
+        if not built:
+            dataset = self.load()
+            return [dataset[note_id] for note_id in note_ids if note_id in dataset]
+        return [self.loads(value) for value in values if value is not None]
+
+    def get_rendered(self, field):
+        """Return the rendered response body stored under ``field`` or None"""
+        body = self.client.hget(self.rendered_key, field)
+        metrics.cache_access(f'{self.key_prefix}-rendered', body is not None)
+        return body
+
+    def set_rendered(self, field, body):
+        """Store a rendered body unless the hash is full, it expires ``rendered_timeout`` seconds after the last one"""
+        if self.client.hlen(self.rendered_key) >= self.rendered_max_fields:
+            return
+        pipe = self.client.pipeline()
+        pipe.hset(self.rendered_key, field, body)
+        pipe.expire(self.rendered_key, self.rendered_timeout)
+        pipe.execute()
+
+    def local(self):
+        """Return all notes of the user by id from the in-process cache, filled from Redis"""
+        return local_cache.get_or_load(self.key_prefix, self.user_id, self.read)
+
+    def read(self):
+        """Return all cached notes of the user by id, rebuilding a missing cache"""
+        dataset = self.client.hgetall(self.key)
+        built = dataset.pop(self.sentinel.encode(), None) is not None
+        metrics.cache_access(self.key_prefix, built)
+        if not built:
+            return self.load()
+        return {int(k): self.loads(v) for k, v in dataset.items()}
+
+    def load(self):
+        """
+        Rebuild a missing cache from the database and return the notes by id.
+        Concurrent callers wait on a Redis lock and reuse the first rebuild;
+        if the lock can not be acquired in time the database is read directly.
+        The notes are read from a replica unless the user wrote recently, a
+        write of the user while they are read discards the rebuild and the
+        notes are read again, up to ``rebuild_retries`` times.
+        """
+        lock = self.client.lock(self.lock_key, timeout=self.lock_timeout, blocking_timeout=self.lock_wait)
+        if not lock.acquire():
+            with replica_reads(self.user_id):
+                return self.build(self.get_queryset())
+        try:
+            pipe = self.client.pipeline()
+            pipe.hgetall(self.key)
+            for index_key in self.index_keys.values():
+                pipe.zscore(index_key, self.sentinel)
+            mapping, *indexed = pipe.execute()
+            if mapping.pop(self.sentinel.encode(), None) is not None and None not in indexed:
+                return {int(k): self.loads(v) for k, v in mapping.items()}
+            version = DataVersion(self.user_id, self.client).key
+            for _ in range(self.rebuild_retries):
+                with self.client.pipeline() as pipe:
+                    # a write-through of the user while the notes are read fails the pipeline
+                    pipe.watch(version)
+                    with replica_reads(self.user_id):
+                        dataset = self.build(self.get_queryset())
+                    pipe.multi()
+                    self.queue_write(pipe, dataset)
+                    try:
+                        pipe.execute()
+                    except WatchError:
+                        continue
+                    return dataset
+            # the notes keep changing, leave the cache to the next read
+            return dataset
+        finally:
+            try:
+                lock.release()
+            except LockError as e:
+                logger.exception(e)
+
+    def set(self, note):
+        """Add or replace a single note with its committed row"""
+        self.refresh([note.id])
+
+    def delete(self, note_id):
+        """Remove a single note"""
+        self.update(deleted=[note_id])
+
+    def update(self, notes=(), deleted=()):
+        """Add or replace ``notes``, remove ``deleted`` note ids and bump the data version in one round trip"""
+        pipe = self.client.pipeline()
+        self.queue_update(pipe, self.build(notes), deleted)
+        pipe.execute()
+
+    def queue_update(self, pipe, dataset, deleted=()):
+        """Queue on ``pipe`` the commands patching the notes of ``dataset`` and removing ``deleted`` ids"""
+        DataVersion(self.user_id, self.client).bump(pipe)
+        pipe.delete(self.rendered_key)
+        if dataset:
+            partitions = {False: {}, True: {}}
+            for note_id, data in dataset.items():
+                partitions[data['is_archived']][note_id] = note_id
+            pipe.hset(self.key, mapping={note_id: self.dumps(data) for note_id, data in dataset.items()})
+            pipe.zadd(self.index_keys[None], {note_id: note_id for note_id in dataset})
+            for archived, index in partitions.items():
+                if index:
+                    pipe.zadd(self.index_keys[archived], index)
+                    pipe.zrem(self.index_keys[not archived], *index)
+        if deleted:
+            pipe.hdel(self.key, *deleted)
+            for index_key in self.index_keys.values():
+                pipe.zrem(index_key, *deleted)
+
+    def refresh(self, note_ids=(), deleted=()):
+        """
+        Re-read notes with given ids from the database once their writes are
+        committed and patch them in the cache, ids no longer found are
+        removed. A write of the user while the notes are read discards the
+        patch and the notes are read again, as in ``load()``; if they keep
+        changing the cache is dropped for the next read to rebuild.
+        """
+        version = DataVersion(self.user_id, self.client).key
+        for _ in range(self.rebuild_retries):
+            with self.client.pipeline() as pipe:
+                pipe.watch(version)
+                notes = list(self.get_queryset().filter(pk__in=note_ids)) if note_ids else []
+                dataset = self.build(notes)
+                pipe.multi()
+                self.queue_update(pipe, dataset, {*deleted, *(set(note_ids) - set(dataset))})
+                try:
+                    pipe.execute()
+                except WatchError:
+                    continue
+                return notes
+        self.invalidate()
+        return notes
+
+    def build(self, queryset):
+        return {note.id: self.to_dict(note) for note in queryset}
+
+    def write(self, dataset):
+        pipe = self.client.pipeline()
+        self.queue_write(pipe, dataset)
+        pipe.execute()
+
+    def queue_write(self, pipe, dataset):
+        """Queue on ``pipe`` the commands replacing the whole cache with the notes of ``dataset``"""
+        mapping = {note_id: self.dumps(data) for note_id, data in dataset.items()}
+        mapping[self.sentinel] = b''
+        indexes = {archived: {self.sentinel: 0} for archived in self.index_keys}
+        for note_id, data in dataset.items():
+            indexes[None][note_id] = note_id
+            indexes[data['is_archived']][note_id] = note_id
+        pipe.delete(self.key, self.rendered_key, *self.index_keys.values())
+        pipe.hset(self.key, mapping=mapping)
+        for archived, index in indexes.items():
+            pipe.zadd(self.index_keys[archived], index)
+
+    def rebuild(self, queryset=None):
+        """Replace the whole cache with the notes of given queryset"""
+        self.write(self.build(self.get_queryset() if queryset is None else queryset))
+
+    def invalidate(self):
+        """Drop the cache and bump the data version"""
+        pipe = self.client.pipeline()
+        DataVersion(self.user_id, self.client).bump(pipe)
+        pipe.delete(self.key, self.rendered_key, *self.index_keys.values())
+        pipe.execute()
+
+    def clear(self):
+        self.client.delete(self.key, self.rendered_key, *self.index_keys.values())
+
+
+class AsyncNoteCache(NoteCache):
+    """
+    asyncio variant of NoteCache over the same Redis keys. Reads and writes
+    of the cache are awaited on the async client; a missing cache is rebuilt
+    by NoteCache in a worker thread, so the single-flight lock is shared.
+    """
+
+    def __init__(self, user_id):
+        super().__init__(user_id, client=get_async_redis_connection())
+
+    async def load(self):
+        return await sync_to_async(NoteCache(self.user_id).load)()
+
+    async def local(self):
+        dataset = local_cache.get(self.key_prefix, self.user_id)
+        if dataset is None:
+            generation = local_cache.generation(self.user_id)
+            dataset = await self.read()
+            local_cache.set(self.key_prefix, self.user_id, dataset, generation, len(dataset) + 1)
+        return dataset
+
+    async def read(self):
+        dataset = await self.client.hgetall(self.key)
+        built = dataset.pop(self.sentinel.encode(), None) is not None
+        metrics.cache_access(self.key_prefix, built)
+        if not built:
+            return await self.load()
+        return {int(k): self.loads(v) for k, v in dataset.items()}
+
+    async def get(self, note_id):
+        if local_cache.enabled:
+            return (await self.local()).get(int(note_id))
+        pipe = self.client.pipeline()
+        pipe.hget(self.key, note_id)
+        pipe.hexists(self.key, self.sentinel)
+        value, built = await pipe.execute()
+        metrics.cache_access(self.key_prefix, built)
+        if not built:
+            return (await self.load()).get(int(note_id))
+        return None if value is None else self.loads(value)
+
+    async def page(self, after=None, limit=None, archived=None, label=None, color=None):
+        if local_cache.enabled:
+            return self.select(await self.local(), after, limit, archived, label, color)
+        if label is not None or color is not None:
+            ids = await sync_to_async(self.filter_ids)(after, limit, archived=archived, label=label, color=color)
+            return await self.get_many(ids)
+        index_key = self.index_keys[archived]
+        pipe = self.client.pipeline()
+        pipe.zrangebyscore(index_key, f'({after or 0}', '+inf', start=0 if limit else None, num=limit)
+        pipe.hexists(self.key, self.sentinel)
+        pipe.zscore(index_key, self.sentinel)
+        ids, built, indexed = await pipe.execute()
+        metrics.cache_access(self.key_prefix, built and indexed is not None)
+        if not built or indexed is None:
+            return self.select(await self.load(), after, limit, archived)
+        if not ids:
+            return []
+        return [self.loads(value) for value in await self.client.hmget(self.key, ids) if value is not None]
+
+    async def get_many(self, note_ids):
+        if not note_ids:
+            return []
+        if local_cache.enabled:
+            dataset = await self.local()
+            return [dataset[note_id] for note_id in note_ids if note_id in dataset]
+        pipe = self.client.pipeline()
+        pipe.hmget(self.key, note_ids)
+        pipe.hexists(self.key, self.sentinel)
+        values, built = await pipe.execute()
+        metrics.cache_access(self.key_prefix, built)
+        if not built:
+            dataset = await self.load()
+            return [dataset[note_id] for note_id in note_ids if note_id in dataset]
+        return [self.loads(value) for value in values if value is not None]
+
+    async def set(self, note):
+        # the committed row is read under WATCH of the data version, on the sync client
+        await sync_to_async(NoteCache(self.user_id).set)(note)
+
+    async def delete(self, note_id):
+        await self.update(deleted=[note_id])
+
+    async def update(self, notes=(), deleted=()):
+        dataset = await sync_to_async(self.build)(notes)
+        pipe = self.client.pipeline()
+        self.queue_update(pipe, dataset, deleted)
+        await pipe.execute()
@@ -0,0 +1,79 @@
+"""
+Encodings of the note cache values. Every value starts with the tag of the
+serializer that wrote it and a compression flag, so values written by a
+previous setting stay readable while the cache turns over.
+"""
+import pickle
+import zlib
+from functools import lru_cache
+
+import msgpack
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+COMPRESSED = b'z'
+PLAIN = b'-'
+# values written before the tags, pickle protocol 2 and later start with PROTO
+LEGACY_PICKLE = pickle.PROTO
+
+
+class PickleSerializer:
+    tag = b'p'
+
+    @staticmethod
+    def dumps(data):
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(value):
+        return pickle.loads(value)
+
+
+class MsgpackSerializer:
+    tag = b'm'
+
+    @staticmethod
+    def dumps(data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    @staticmethod
+    def loads(value):
+        return msgpack.unpackb(value, raw=False, strict_map_key=False)
+
+
+SERIALIZERS = {serializer.tag: serializer for serializer in (PickleSerializer, MsgpackSerializer)}
+
+
+class CacheCodec:
+    """Serialize with ``serializer``, zlib compressing values of ``compress_min_size`` bytes or more"""
+
+    def __init__(self, serializer, compress_min_size=None, compress_level=6):
+        self.serializer = serializer
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+
+    def dumps(self, data):
+        value = self.serializer.dumps(data)
+        if self.compress_min_size is not None and len(value) >= self.compress_min_size:
+            compressed = zlib.compress(value, self.compress_level)
+            if len(compressed) < len(value):
+                return self.serializer.tag + COMPRESSED + compressed
+        return self.serializer.tag + PLAIN + value
+
+    @staticmethod
+    def loads(value):
+        if value[:1] == LEGACY_PICKLE:
+            return pickle.loads(value)
+        tag, flag, value = value[:1], value[1:2], value[2:]
+        if flag == COMPRESSED:
+            value = zlib.decompress(value)
+        return SERIALIZERS[tag].loads(value)
+
+
+@lru_cache(maxsize=None)
+def get_note_cache_codec():
+    """Return the codec configured by NOTE_CACHE_SERIALIZER and NOTE_CACHE_COMPRESS_MIN_SIZE"""
+    return CacheCodec(
+        import_string(settings.NOTE_CACHE_SERIALIZER),
+        compress_min_size=settings.NOTE_CACHE_COMPRESS_MIN_SIZE,
+    )
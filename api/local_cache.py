@@ -0,0 +1,154 @@
+"""
+In-process tier in front of the Redis caches. Entries hold one user's data
+per namespace and are dropped whenever the user's DataVersion is bumped:
+right away in the writing process, and in every other process by a message
+on INVALIDATION_CHANNEL read by a listener thread. The tier only serves
+reads while its listener runs, so a lost subscription can not serve stale
+data; entries also expire after LOCAL_CACHE_TTL seconds.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from api.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'cache:invalidate'
+
+
+class LocalCache:
+    """LRU of per-user values bounded by LOCAL_CACHE_MAX_ITEMS, the sum of the entry weights"""
+    namespaces = ('notes', 'labels')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # a load stores its value only if the user's generation did not change
+        # meanwhile; numbers are never reused, so a user dropped and tracked
+        # again can not match a load started before
+        self.counter = 0
+        self.generations = OrderedDict()
+        self.size = 0
+        self.listener = None
+
+    @property
+    def enabled(self):
+        return settings.LOCAL_CACHE_MAX_ITEMS > 0
+
+    def get(self, namespace, user_id):
+        entry = None
+        if self.listen():
+            with self.lock:
+                entry = self.entries.get((namespace, user_id))
+                if entry is not None and entry[0] < time.monotonic():
+                    self.pop((namespace, user_id))
+                    entry = None
+                elif entry is not None:
+                    self.entries.move_to_end((namespace, user_id))
+                    self.generations.move_to_end(user_id)
+        metrics.cache_access(f'{namespace}-local', entry is not None)
+        return None if entry is None else entry[2]
+
+    def generation(self, user_id):
+        with self.lock:
+            if user_id not in self.generations:
+                self.counter += 1
+                self.generations[user_id] = self.counter
+            self.generations.move_to_end(user_id)
+            # users are tracked only as long as their entries, at most LOCAL_CACHE_MAX_ITEMS
+            while len(self.generations) > settings.LOCAL_CACHE_MAX_ITEMS:
+                self.forget(next(iter(self.generations)))
+            return self.generations[user_id]
+
+    def set(self, namespace, user_id, value, generation, weight=1):
+        """Keep ``value`` unless the user was invalidated since ``generation`` was read"""
+        if weight > settings.LOCAL_CACHE_MAX_ITEMS:
+            return
+        with self.lock:
+            if self.generations.get(user_id) != generation:
+                return
+            self.pop((namespace, user_id))
+            self.entries[(namespace, user_id)] = (time.monotonic() + settings.LOCAL_CACHE_TTL, weight, value)
+            self.size += weight
+            while self.size > settings.LOCAL_CACHE_MAX_ITEMS:
+                key = next(iter(self.entries))
+                self.pop(key)
+                if not any((other, key[1]) in self.entries for other in self.namespaces):
+                    self.generations.pop(key[1], None)
+
+    def get_or_load(self, namespace, user_id, load, weight=len):
+        value = self.get(namespace, user_id)
+        if value is None:
+            generation = self.generation(user_id)
+            value = load()
+            self.set(namespace, user_id, value, generation, weight(value) + 1)
+        return value
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def forget(self, user_id):
+        self.generations.pop(user_id, None)
+        for namespace in self.namespaces:
+            self.pop((namespace, user_id))
+
+    def invalidate(self, user_id):
+        with self.lock:
+            if user_id in self.generations:
+                self.counter += 1
+                self.generations[user_id] = self.counter
+            for namespace in self.namespaces:
+                self.pop((namespace, user_id))
+
+    def clear(self):
+        with self.lock:
+            self.reset()
+
+    def reset(self):
+        self.generations.clear()
+        self.entries.clear()
+        self.size = 0
+
+    def listen(self):
+        """Start the invalidation listener if needed, return whether it runs"""
+        if self.listener is not None and self.listener.is_alive():
+            return True
+        with self.lock:
+            if self.listener is not None and self.listener.is_alive():
+                return True
+            try:
+                pubsub = get_redis_connection().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{INVALIDATION_CHANNEL: self.on_message})
+                self.listener = pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=self.on_error)
+            except Exception as e:
+                logger.exception(e)
+                return False
+        # messages sent before the subscription are lost
+        self.clear()
+        return True
+
+    def on_message(self, message):
+        self.invalidate(int(message['data']))
+
+    def on_error(self, e, pubsub, thread):
+        logger.exception(e)
+        thread.stop()
+        pubsub.close()
+        self.clear()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener.join(timeout=5)
+            self.listener = None
+        self.clear()
+
+
+local_cache = LocalCache()
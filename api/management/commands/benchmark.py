@@ -0,0 +1,232 @@
+import copy
+import json
+import math
+import subprocess
+import time
+from collections import defaultdict
+from unittest import mock
+from urllib.parse import urlsplit, urlunsplit
+
+import fakeredis
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, \
+    teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+from django_redis import get_redis_connection
+from rest_framework.test import APIClient
+
+from api.cache import NoteCache
+from api.models import Label, Note, User
+from api.tasks import task_drain_email_outbox
+
+PASSWORD = 'benchmark-password'
+NOTE_ARCHIVE_ENDPOINT = '/api/note-archive/{}/'
+NOTE_COLOR_ENDPOINT = '/api/update-color/{}/'
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted ``values``"""
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+class Benchmark:
+    """
+    Seed users with notes and labels, then drive the API workloads through the
+    URLconf with the test client, recording latency and database queries of
+    every request by endpoint name.
+    """
+
+    def __init__(self, users=10, notes=50, labels=5, rounds=5):
+        self.users = users
+        self.notes = notes
+        self.labels = labels
+        self.rounds = rounds
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def seed(self):
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([
+            User(username=f'bench{i}', email=f'bench{i}@example.com', password=password) for i in range(self.users)
+        ])
+        owners = list(User.objects.filter(username__startswith='bench'))
+        Note.objects.bulk_create([
+            Note(user=owner, title=f'note {i}', description=f'benchmark note {i} of {owner.email}')
+            for owner in owners for i in range(self.notes)
+        ])
+        Label.objects.bulk_create([
+            Label(author=owner, title=f'label {i}', color='blue') for owner in owners for i in range(self.labels)
+        ])
+        # measure steady state reads, not the first read-through of each cache
+        for owner in owners:
+            NoteCache(owner.id).rebuild()
+        return owners
+
+    def call(self, name, method, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = method(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+        self.samples[name].append((elapsed, len(queries)))
+        if response.status_code >= 400:
+            self.errors[name] += 1
+        return response
+
+    @staticmethod
+    def unthrottled():
+        """Settings keeping the throttles in the request path with buckets the workloads cannot empty"""
+        rates = {scope: f'{10 ** 9}/s' for scope in settings.REST_FRAMEWORK.get('DEFAULT_THROTTLE_RATES', {})}
+        return override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': rates})
+
+    def run(self):
+        owners = self.seed()
+        started = time.perf_counter()
+        # registrations start the outbox drain on a worker, not part of the measured request
+        with self.unthrottled(), mock.patch.object(task_drain_email_outbox, 'delay'):
+            for n in range(self.rounds):
+                for owner in owners:
+                    self.run_user(owner, n)
+        elapsed = time.perf_counter() - started
+        return self.report(elapsed)
+
+    def run_user(self, owner, n):
+        anonymous = APIClient()
+        self.call('register', anonymous.post, reverse('auth-register'), {
+            'username': f'new{owner.id}-{n}', 'email': f'new{owner.id}-{n}@example.org', 'password': PASSWORD,
+        })
+        response = self.call('login', anonymous.post, reverse('login'), {'email': owner.email, 'password': PASSWORD})
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+
+        response = self.call('note-create', client.post, reverse('notes-list'), {
+            'title': f'round {n}', 'description': f'benchmark round {n}',
+        }, format='json')
+        pk = response.data['data']['id']
+        self.call('note-retrieve', client.get, reverse('notes-detail', args=[pk]))
+        self.call('note-update', client.put, reverse('notes-detail', args=[pk]), {
+            'title': f'round {n} updated', 'description': f'benchmark round {n}', 'user': owner.id,
+        }, format='json')
+        self.call('note-list', client.get, reverse('notes-list'))
+        self.call('note-archive', client.put, NOTE_ARCHIVE_ENDPOINT.format(pk), {'is_archived': True}, format='json')
+        self.call('note-color', client.put, NOTE_COLOR_ENDPOINT.format(pk), {'color': 'red'}, format='json')
+        self.call('note-list-archived', client.get, reverse('notes-list'), {'archived': 'true'})
+        self.call('note-delete', client.delete, reverse('notes-detail', args=[pk]))
+        self.call('label-create', client.post, reverse('labels-list'), {
+            'title': f'round {n}', 'color': 'green',
+        }, format='json')
+        self.call('label-list', client.get, reverse('labels-list'))
+
+    def report(self, elapsed):
+        endpoints = {}
+        for name, samples in self.samples.items():
+            latencies = sorted(sample[0] for sample in samples)
+            queries = [sample[1] for sample in samples]
+            endpoints[name] = {
+                'requests': len(samples),
+                'errors': self.errors[name],
+                'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+                'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+                'rps': round(len(latencies) / sum(latencies), 1),
+                'queries_mean': round(sum(queries) / len(queries), 2),
+                'queries_max': max(queries),
+            }
+        total = sum(len(samples) for samples in self.samples.values())
+        return {
+            'requests': total,
+            'elapsed_s': round(elapsed, 3),
+            'rps': round(total / elapsed, 1) if elapsed else None,
+            'endpoints': endpoints,
+        }
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the API end to end on a throwaway test database: seed users with notes and labels, '
+        'drive the note, label and auth workloads through the URLconf and report latency percentiles, '
+        'requests per second and database queries per endpoint as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10, help='number of seeded users')
+        parser.add_argument('--notes', type=int, default=50, help='notes seeded per user')
+        parser.add_argument('--labels', type=int, default=5, help='labels seeded per user')
+        parser.add_argument('--rounds', type=int, default=5, help='workload rounds per user')
+        parser.add_argument('--output', default='benchmark.json', help='file the JSON results are written to')
+        parser.add_argument('--redis', action='store_true',
+                            help='use the configured Redis server instead of an in-memory fakeredis')
+        parser.add_argument('--redis-db', type=int, default=15,
+                            help='database of the Redis server used with --redis, it must be empty and is flushed '
+                                 'after the run')
+
+    @staticmethod
+    def get_commit():
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    @staticmethod
+    def fake_caches():
+        caches = copy.deepcopy(settings.CACHES)
+        options = caches['default'].setdefault('OPTIONS', {})
+        options.setdefault('CONNECTION_POOL_KWARGS', {})['connection_class'] = fakeredis.FakeConnection
+        return caches
+
+    @staticmethod
+    def redis_caches(db):
+        """The configured caches moved to Redis database ``db``, keeping the benchmark keys apart from real ones"""
+        caches = copy.deepcopy(settings.CACHES)
+        location = urlsplit(caches['default']['LOCATION'])
+        caches['default']['LOCATION'] = urlunsplit(location._replace(path=f'/{db}'))
+        return caches
+
+    @staticmethod
+    def benchmark(options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            benchmark = Benchmark(options['users'], options['notes'], options['labels'], options['rounds'])
+            return benchmark.run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def handle(self, *args, **options):
+        caches = self.redis_caches(options['redis_db']) if options['redis'] else self.fake_caches()
+        with override_settings(CACHES=caches):
+            client = get_redis_connection()
+            if options['redis'] and client.dbsize():
+                raise CommandError(f"Redis database {options['redis_db']} is not empty, pick another with --redis-db")
+            try:
+                results = self.benchmark(options)
+            finally:
+                # every key in the database was written by this run
+                client.flushdb()
+
+        results.update({
+            'commit': self.get_commit(),
+            'created_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'redis': 'redis' if options['redis'] else 'fakeredis',
+            'options': {key: options[key] for key in ('users', 'notes', 'labels', 'rounds')},
+        })
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+        self.stdout.write(f"{'endpoint':<20}{'requests':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+                          f"{'rps':>10}{'queries':>9}")
+        for name, row in results['endpoints'].items():
+            self.stdout.write(f"{name:<20}{row['requests']:>9}{row['p50_ms']:>10}{row['p95_ms']:>10}"
+                              f"{row['p99_ms']:>10}{row['rps']:>10}{row['queries_mean']:>9}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{results['requests']} requests in {results['elapsed_s']}s, {results['rps']} rps, "
+            f"results written to {options['output']}"
+        ))
@@ -0,0 +1,59 @@
+import pickle
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.cache import NoteCache
+from api.cache_serializers import CacheCodec, MsgpackSerializer, PickleSerializer, get_note_cache_codec
+from api.models import Note
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the note cache of a sample of users under each value encoding: encode the notes of every '
+        'sampled user read from the database and report bytes per user and the ratio to plain pickle.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='number of users sampled, the first ids with notes')
+        parser.add_argument('--user-id', type=int, action='append', dest='user_ids', help='measure given user ids')
+        parser.add_argument('--compress-min-size', type=int, default=settings.NOTE_CACHE_COMPRESS_MIN_SIZE,
+                            help='compression threshold of the zlib candidates')
+
+    @staticmethod
+    def get_codecs(threshold):
+        return {
+            # values written before NOTE_CACHE_SERIALIZER existed
+            'pickle': pickle.dumps,
+            'pickle+zlib': CacheCodec(PickleSerializer, threshold).dumps,
+            'msgpack': CacheCodec(MsgpackSerializer).dumps,
+            'msgpack+zlib': CacheCodec(MsgpackSerializer, threshold).dumps,
+            'configured': get_note_cache_codec().dumps,
+        }
+
+    def handle(self, *args, **options):
+        user_ids = options['user_ids'] or sorted({
+            user_id for shard in settings.NOTE_SHARDS
+            for user_id in Note.objects.using(shard).order_by('user_id').values_list('user_id', flat=True)
+            .distinct()[:options['users']]
+        })[:options['users']]
+        codecs = self.get_codecs(options['compress_min_size'])
+        totals = dict.fromkeys(codecs, 0)
+        notes = 0
+        for user_id in user_ids:
+            note_cache = NoteCache(user_id)
+            dataset = note_cache.build(note_cache.get_queryset())
+            notes += len(dataset)
+            for name, dumps in codecs.items():
+                totals[name] += sum(len(str(note_id)) + len(dumps(data)) for note_id, data in dataset.items())
+
+        if not user_ids:
+            self.stdout.write('No users with notes')
+            return
+        self.stdout.write(f'{len(user_ids)} users, {notes} notes')
+        self.stdout.write(f"{'encoding':<16}{'bytes':>14}{'bytes/user':>14}{'bytes/note':>12}{'ratio':>8}")
+        for name, total in totals.items():
+            self.stdout.write(
+                f"{name:<16}{total:>14}{total // len(user_ids):>14}{total // max(notes, 1):>12}"
+                f"{total / max(totals['pickle'], 1):>8.2f}"
+            )
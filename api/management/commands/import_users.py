@@ -0,0 +1,141 @@
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.models import EmailOutbox, User, UserShard, drain_email_outbox_on_commit
+from api.sharding import assign_shard
+
+FORMATS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+
+
+def hash_password(raw):
+    """Hash in a worker process, users without a password get an unusable one"""
+    return make_password(raw or None)
+
+
+class Command(BaseCommand):
+    help = (
+        'Import users from a CSV or NDJSON file with the columns email, username, password, password_hash and '
+        'is_verified. Passwords are hashed in a process pool while the previous chunk is inserted with '
+        'bulk_create; emails already taken are skipped. No post_save signal runs: verification emails are only '
+        'written to the outbox, in bulk, with --send-verification.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="file to import, - reads stdin")
+        parser.add_argument('--format', choices=sorted(set(FORMATS.values())), help='defaults to the file extension')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='password hashing processes, 1 hashes in this process')
+        parser.add_argument('--send-verification', action='store_true',
+                            help='queue a verification email to every imported user')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or FORMATS.get(os.path.splitext(path)[1].lower())
+        if fmt is None:
+            raise CommandError('--format is required when the file extension is not .csv, .ndjson or .jsonl')
+        self.send_verification = options['send_verification']
+        self.counts = dict.fromkeys(('read', 'created', 'existing', 'skipped'), 0)
+        started = time.perf_counter()
+
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        workers = options['workers']
+        pool = ProcessPoolExecutor(workers, initializer=django.setup) if workers > 1 else None
+        try:
+            records = self.read(stream, fmt)
+            previous = None
+            while True:
+                rows = list(islice(records, options['chunk_size']))
+                chunk = self.prepare(rows)
+                if chunk:
+                    passwords = [record['password'] for record in chunk if 'password_hash' not in record]
+                    if pool is None:
+                        hashes = map(hash_password, passwords)
+                    else:
+                        # submitted now, hashed while the previous chunk is inserted
+                        hashes = pool.map(hash_password, passwords, chunksize=max(1, len(passwords) // (4 * workers)))
+                if previous is not None:
+                    self.insert(*previous)
+                if not rows:
+                    break
+                # a chunk of skipped rows only is not the end of the file
+                previous = (chunk, hashes) if chunk else None
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+            if stream is not sys.stdin:
+                stream.close()
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            ', '.join(f'{count} {name}' for name, count in self.counts.items())
+            + f' in {elapsed:.1f}s, {self.counts["created"] / max(elapsed, 1e-9):.0f} users/s'
+        ))
+
+    @staticmethod
+    def read(stream, fmt):
+        if fmt == 'csv':
+            yield from csv.DictReader(stream)
+            return
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+    def prepare(self, records):
+        """Normalize the records of a chunk, dropping those without email and repeated emails"""
+        prepared, emails = [], set()
+        for record in records:
+            self.counts['read'] += 1
+            email = User.objects.normalize_email((record.get('email') or '').strip())
+            if not email or email in emails:
+                self.counts['skipped'] += 1
+                continue
+            emails.add(email)
+            verified = record.get('is_verified')
+            prepared.append({
+                'email': email,
+                'username': record.get('username') or None,
+                'password': record.get('password') or None,
+                'is_verified': verified in (True, 'true', 'True', '1', 1),
+                **({'password_hash': record['password_hash']} if record.get('password_hash') else {}),
+            })
+        return prepared
+
+    def insert(self, records, hashes):
+        hashes = iter(hashes)
+        users = [
+            User(
+                email=record['email'], username=record['username'], is_verified=record['is_verified'],
+                password=record['password_hash'] if 'password_hash' in record else next(hashes),
+            )
+            for record in records
+        ]
+        with transaction.atomic():
+            existing = set(User.objects.filter(email__in=[user.email for user in users]).values_list('email', flat=True))
+            users = [user for user in users if user.email not in existing]
+            User.objects.bulk_create(users, batch_size=len(users) or None)
+            if any(user.pk is None for user in users):
+                # backends not returning ids from bulk inserts
+                ids = dict(User.objects.filter(email__in=[user.email for user in users]).values_list('email', 'id'))
+                for user in users:
+                    user.pk = ids[user.email]
+            if len(settings.NOTE_SHARDS) > 1:
+                UserShard.objects.bulk_create([UserShard(user_id=user.pk, shard=assign_shard(user.pk)) for user in users])
+            if self.send_verification:
+                EmailOutbox.objects.bulk_create([
+                    EmailOutbox(kind=EmailOutbox.VERIFY_USER, user_id=user.pk, email=user.email) for user in users
+                ])
+                drain_email_outbox_on_commit()
+        self.counts['existing'] += len(existing)
+        self.counts['created'] += len(users)
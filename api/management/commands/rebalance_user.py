@@ -0,0 +1,112 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+
+from api.cache import DataVersion
+from api.models import Label, Note, NoteLabel, Tombstone, UserShard
+from api.sharding import moving_cache_key, shard_cache_key, shard_for_user
+
+CHUNK_SIZE = 1000
+# seconds: in flight writes finish within WAIT, a move within LOCK_TIMEOUT
+WAIT = 5
+LOCK_TIMEOUT = 60 * 60
+
+
+class Command(BaseCommand):
+    help = (
+        'Move the notes, labels and tombstones of a user to another shard. The writes of the user are refused '
+        'during the move, the rows are copied with their ids and timestamps, then removed from the source in '
+        'the transaction switching the placement. The ids stay free on the target, every shard draws new ids '
+        'from its own NOTE_SHARD_ID_RANGE. A failed move removes the copies and leaves the user on the source.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_id', type=int)
+        parser.add_argument('shard', help='alias of NOTE_SHARDS to move the user to')
+        parser.add_argument('--wait', type=float, default=WAIT,
+                            help='seconds given to the writes started before the move to finish')
+
+    def handle(self, *args, **options):
+        user_id, target = options['user_id'], options['shard']
+        if target not in settings.NOTE_SHARDS:
+            raise CommandError(f'{target} is not one of NOTE_SHARDS {settings.NOTE_SHARDS}')
+        source = shard_for_user(user_id)
+        if source == target:
+            self.stdout.write(f'user {user_id} is already on {target}')
+            return
+
+        cache.set(moving_cache_key(user_id), target, timeout=LOCK_TIMEOUT)
+        try:
+            time.sleep(options['wait'])
+            rows = self.move(user_id, source, target)
+        finally:
+            cache.delete(moving_cache_key(user_id))
+        DataVersion(user_id).bump()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'moved user {user_id} from {source} to {target}: '
+            + ', '.join(f'{len(instances)} {model._meta.verbose_name_plural}' for model, instances in rows.items())
+        ))
+
+    def move(self, user_id, source, target):
+        rows = {
+            Note: list(Note.objects.using(source).filter(user_id=user_id)),
+            Label: list(Label.objects.using(source).filter(author_id=user_id)),
+            NoteLabel: list(NoteLabel.objects.using(source).filter(note__user_id=user_id)),
+            Tombstone: list(Tombstone.objects.using(source).filter(user_id=user_id)),
+        }
+        with transaction.atomic(using=target):
+            for model, instances in rows.items():
+                self.copy(model, instances, target)
+        try:
+            # the placement commits with or right before the source, the cache follows both
+            with transaction.atomic(using=source):
+                for model in (NoteLabel, Tombstone, Note, Label):
+                    self.delete(model, [instance.pk for instance in rows[model]], source)
+                left = sum(
+                    model.objects.using(source).filter(**{field: user_id}).count()
+                    for model, field in ((Note, 'user_id'), (Label, 'author_id'), (Tombstone, 'user_id'))
+                )
+                if left:
+                    raise CommandError(f'{left} rows were written on {source} during the move, nothing was moved')
+                with transaction.atomic(using=router.db_for_write(UserShard)):
+                    UserShard.objects.update_or_create(user_id=user_id, defaults={'shard': target})
+                transaction.on_commit(lambda: cache.set(shard_cache_key(user_id), target), using=source)
+        except Exception:
+            if UserShard.objects.filter(user_id=user_id, shard=target).exists():
+                # the placement committed before the source failed: the user lives on the target now,
+                # the rows left on the source are unreachable copies
+                cache.set(shard_cache_key(user_id), target)
+                self.stderr.write(f'the copies of user {user_id} on {source} were not deleted')
+            else:
+                for model in (NoteLabel, Tombstone, Note, Label):
+                    self.delete(model, [instance.pk for instance in rows[model]], target)
+            raise
+        return rows
+
+    @staticmethod
+    def copy(model, instances, target):
+        """bulk_create keeping the ids and the auto_now timestamps of ``instances``"""
+        stamps = [
+            field.attname for field in model._meta.concrete_fields
+            if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+        ]
+        values = [{name: getattr(instance, name) for name in stamps} for instance in instances]
+        model.objects.using(target).bulk_create(instances, batch_size=CHUNK_SIZE)
+        if stamps and instances:
+            for instance, stamp in zip(instances, values):
+                for name, value in stamp.items():
+                    setattr(instance, name, value)
+            model.objects.using(target).bulk_update(instances, stamps, batch_size=CHUNK_SIZE)
+
+    @staticmethod
+    def delete(model, pks, using):
+        """Delete rows by id in SQL, a move is not a delete: no signals, no tombstones"""
+        table = connections[using].ops.quote_name(model._meta.db_table)
+        with connections[using].cursor() as cursor:
+            for start in range(0, len(pks), CHUNK_SIZE):
+                chunk = pks[start:start + CHUNK_SIZE]
+                cursor.execute(f'DELETE FROM {table} WHERE id IN ({", ".join(["%s"] * len(chunk))})', chunk)
@@ -0,0 +1,124 @@
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Prefetch
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+from api.cache import DataVersion, NoteCache
+from api.models import Label, Note, User
+from api.sharding import shard_for_user
+
+CURSOR_KEY = 'warm_note_cache:cursor'
+RETRIES = 3
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the note caches of all users, or of the users logged in recently, in chunks of users warmed in '
+        'parallel: one query reads the notes of a whole chunk per shard and one Redis pipeline writes its caches. '
+        'The last user id of the chunks done is kept in Redis, an interrupted run continues from there.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='users per query and pipeline')
+        parser.add_argument('--workers', type=int, default=4, help='chunks warmed in parallel')
+        parser.add_argument('--active-days', type=int, help='only users logged in during the last given days')
+        parser.add_argument('--missing-only', action='store_true', help='skip users with a built cache')
+        parser.add_argument('--restart', action='store_true', help='start from the first user, not the saved cursor')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        client = get_redis_connection()
+        users = User.objects.order_by('pk')
+        if options['active_days'] is not None:
+            users = users.filter(last_login__gte=timezone.now() - timedelta(days=options['active_days']))
+        cursor = None if options['restart'] else client.get(CURSOR_KEY)
+        if cursor is not None:
+            users = users.filter(pk__gt=int(cursor))
+            self.stdout.write(f'resuming after user {int(cursor)}')
+
+        self.totals = {'users': 0, 'notes': 0, 'chunks': 0}
+        self.started = time.perf_counter()
+        user_ids = users.values_list('pk', flat=True).iterator(options['chunk_size'])
+        with ThreadPoolExecutor(options['workers']) as pool:
+            # chunks are finished in order, the cursor never passes a chunk not done yet
+            pending = deque()
+            for chunk in iter(lambda: list(islice(user_ids, options['chunk_size'])), []):
+                pending.append((chunk[-1], pool.submit(self.warm, chunk, options['missing_only'])))
+                if len(pending) >= 2 * options['workers']:
+                    self.done(client, *pending.popleft())
+            while pending:
+                self.done(client, *pending.popleft())
+        client.delete(CURSOR_KEY)
+
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(self.style.SUCCESS(
+            f"warmed {self.totals['users']} users, {self.totals['notes']} notes in {elapsed:.1f}s: "
+            f"{self.totals['users'] / max(elapsed, 1e-9):.0f} users/s, {self.totals['notes'] / max(elapsed, 1e-9):.0f} notes/s"
+        ))
+
+    def done(self, client, last_user_id, future):
+        users, notes = future.result()
+        client.set(CURSOR_KEY, last_user_id)
+        self.totals['users'] += users
+        self.totals['notes'] += notes
+        self.totals['chunks'] += 1
+        if self.verbosity > 1:
+            elapsed = time.perf_counter() - self.started
+            self.stdout.write(
+                f"chunk {self.totals['chunks']} up to user {last_user_id}: {users} users, {notes} notes, "
+                f"{self.totals['users'] / max(elapsed, 1e-9):.0f} users/s"
+            )
+
+    def warm(self, user_ids, missing_only):
+        """Rebuild the caches of ``user_ids``, return the number of users and notes written"""
+        try:
+            client = get_redis_connection()
+            if missing_only:
+                pipe = client.pipeline(transaction=False)
+                for user_id in user_ids:
+                    pipe.hexists(NoteCache(user_id, client).key, NoteCache.sentinel)
+                user_ids = [user_id for user_id, built in zip(user_ids, pipe.execute()) if not built]
+            if not user_ids:
+                return 0, 0
+            versions = [DataVersion(user_id, client).key for user_id in user_ids]
+            for _ in range(RETRIES):
+                with client.pipeline() as pipe:
+                    # a write of one of the users while its notes are read fails the pipeline
+                    pipe.watch(*versions)
+                    datasets = self.read(user_ids)
+                    pipe.multi()
+                    for user_id in user_ids:
+                        NoteCache(user_id, client).queue_write(pipe, datasets[user_id])
+                    try:
+                        pipe.execute()
+                    except WatchError:
+                        continue
+                    return len(user_ids), sum(len(dataset) for dataset in datasets.values())
+            # busy users, let their own rebuild lock order the writes
+            for user_id in user_ids:
+                NoteCache(user_id, client).clear()
+            return 0, 0
+        finally:
+            # connections are per thread
+            connections.close_all()
+
+    @staticmethod
+    def read(user_ids):
+        """Return the cache datasets of ``user_ids``, one notes query per shard"""
+        shards = defaultdict(list)
+        for user_id in user_ids:
+            shards[shard_for_user(user_id)].append(user_id)
+        datasets = {user_id: {} for user_id in user_ids}
+        labels = Prefetch('labels', queryset=Label.objects.only('id'))
+        for shard, ids in shards.items():
+            for note in Note.objects.using(shard).filter(user_id__in=ids).prefetch_related(labels):
+                datasets[note.user_id][note.id] = NoteCache.to_dict(note)
+        return datasets
@@ -0,0 +1,94 @@
+"""
+In-process metrics registry rendered in the Prometheus text exposition
+format. Every worker process aggregates its own requests; Prometheus
+scrapes each worker and sums the series.
+"""
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'api_requests_total': ('counter', 'Requests by route, method and status code', None),
+    'api_request_duration_seconds': ('histogram', 'Request latency by route and method', LATENCY_BUCKETS),
+    'api_db_queries': ('histogram', 'Database queries per request by route', QUERY_BUCKETS),
+    'api_db_query_duration_seconds_total': ('counter', 'Time spent in database queries by route', None),
+    'api_response_size_bytes': ('histogram', 'Response body size by route', SIZE_BUCKETS),
+    'api_cache_requests_total': ('counter', 'Cache reads by cache and result, hit or miss', None),
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def format_labels(labels, **extra):
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class MetricsRegistry:
+    """Thread safe counters and histograms keyed by metric name and label values"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.series = defaultdict(dict)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(labels.items())
+        with self.lock:
+            series = self.series[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(labels.items())
+        with self.lock:
+            series = self.series[name]
+            if key not in series:
+                series[key] = Histogram(METRICS[name][2])
+            series[key].observe(value)
+
+    def cache_access(self, cache, hit):
+        self.inc('api_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, description, buckets) in METRICS.items():
+                series = self.series.get(name)
+                if not series:
+                    continue
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in series.items():
+                    if kind != 'histogram':
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+                        continue
+                    cumulative = 0
+                    for bound, count in zip((*buckets, '+Inf'), value.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {value.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from api.metrics import metrics
+
+# counter of the request being handled, contextvars follow the request into sync_to_async threads
+current_counter = ContextVar('query_counter', default=None)
+
+
+class QueryCounter:
+    """Database execute wrapper counting queries and the time spent in them"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+def count_query(execute, sql, params, many, context):
+    """Execute wrapper of every connection, counting into the counter of the current request"""
+    counter = current_counter.get()
+    if counter is None:
+        return execute(sql, params, many, context)
+    return counter(execute, sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """
+    connection_created receiver wrapping the connections of every thread,
+    the wrappers of a connection outlive its reconnects
+    """
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+class MetricsMiddleware:
+    """
+    Record latency, database queries, and response size of every request by
+    route, the name of the resolved URL pattern. Works for the sync and the
+    async handler.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with self.count_queries(counter):
+            response = self.get_response(request)
+        self.record(request, response, counter, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with self.count_queries(counter):
+            response = await self.get_response(request)
+        self.record(request, response, counter, time.perf_counter() - start)
+        return response
+
+    @staticmethod
+    @contextmanager
+    def count_queries(counter):
+        token = current_counter.set(counter)
+        try:
+            yield counter
+        finally:
+            current_counter.reset(token)
+
+    @staticmethod
+    def record(request, response, counter, duration):
+        match = getattr(request, 'resolver_match', None)
+        route = match.view_name if match else 'unmatched'
+        metrics.inc('api_requests_total', route=route, method=request.method, status=response.status_code)
+        metrics.observe('api_request_duration_seconds', duration, route=route, method=request.method)
+        metrics.observe('api_db_queries', counter.count, route=route)
+        metrics.inc('api_db_query_duration_seconds_total', counter.duration, route=route)
+        if not response.streaming:
+            metrics.observe('api_response_size_bytes', len(response.content), route=route)
@@ -0,0 +1,52 @@
+# Generated by Django 4.0.10 on 2026-10-18 13:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_alter_note_options_alter_note_color'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoteLabel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ],
+            options={
+                'verbose_name': 'note label',
+                'verbose_name_plural': 'note labels',
+                'db_table': 'note_label',
+            },
+        ),
+        migrations.AlterModelOptions(
+            name='note',
+            options={'ordering': ['pk'], 'verbose_name': 'note', 'verbose_name_plural': 'notes'},
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='note',
+            field=models.ManyToManyField(blank=True, related_name='labels', through='api.NoteLabel', to='api.note'),
+        ),
+        migrations.AddField(
+            model_name='notelabel',
+            name='label',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.label'),
+        ),
+        migrations.AddField(
+            model_name='notelabel',
+            name='note',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.note'),
+        ),
+        migrations.AddIndex(
+            model_name='notelabel',
+            index=models.Index(fields=['label', 'note'], name='note_label_label_note_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='notelabel',
+            constraint=models.UniqueConstraint(fields=('note', 'label'), name='note_label_unique'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.0.10 on 2026-10-18 13:47
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+SEARCH_VECTOR_SQL = """
+CREATE FUNCTION note_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.description, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER note_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, description, search_vector ON note
+    FOR EACH ROW EXECUTE PROCEDURE note_search_vector_update();
+
+UPDATE note SET search_vector = NULL;
+"""
+
+REVERSE_SEARCH_VECTOR_SQL = """
+DROP TRIGGER IF EXISTS note_search_vector_trigger ON note;
+DROP FUNCTION IF EXISTS note_search_vector_update();
+"""
+
+
+def create_search_vector_trigger(apps, schema_editor):
+    # full text search is PostgreSQL only, other databases keep the column empty
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(SEARCH_VECTOR_SQL)
+
+
+def drop_search_vector_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(REVERSE_SEARCH_VECTOR_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_note_label'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='note_search_vector_gin'),
+        ),
+        migrations.RunPython(create_search_vector_trigger, drop_search_vector_trigger),
+    ]
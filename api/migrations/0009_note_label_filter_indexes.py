@@ -0,0 +1,25 @@
+# Generated by Django 4.0.10 on 2026-10-18 13:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_note_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='label',
+            index=models.Index(fields=['author', 'is_archived', 'id'], name='label_author_archived_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['user', 'is_archived', 'id'], name='note_user_archived_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['user', 'color', 'id'], name='note_user_color_id_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.0.10 on 2026-10-18 13:55
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_note_label_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('verify_user', 'verify user'), ('forget_password', 'forget password')], max_length=50)),
+                ('email', models.EmailField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'email outbox',
+                'verbose_name_plural': 'email outbox',
+                'db_table': 'email_outbox',
+                'ordering': ['pk'],
+            },
+        ),
+    ]
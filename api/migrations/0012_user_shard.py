@@ -0,0 +1,37 @@
+# Generated by Django 4.0.10 on 2026-10-18 14:08
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_change_tracking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserShard',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('shard', models.CharField(max_length=100)),
+            ],
+            options={
+                'verbose_name': 'user shard',
+                'verbose_name_plural': 'user shards',
+                'db_table': 'user_shard',
+            },
+        ),
+        migrations.AlterField(
+            model_name='label',
+            name='author',
+            field=models.ForeignKey(db_constraint=len(settings.NOTE_SHARDS) == 1, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='note',
+            name='user',
+            field=models.ForeignKey(db_constraint=len(settings.NOTE_SHARDS) == 1, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
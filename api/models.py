@@ -1,12 +1,20 @@
 import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
-from django.db.models.signals import post_save
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.utils import timezone
 
-from api.tasks import task_send_verify_user_email
+from api.sharding import UserShardedManager, assign_shard, shard_cache_key, shard_for_user
+from api.utils import user_cache_key
 
-logger = logging.getLevelName(__name__)
+logger = logging.getLogger(__name__)
 
 
 # Create your models here.
@@ -26,41 +34,204 @@ class User(AbstractUser):
         verbose_name_plural = 'users'
 
 
-def user_post_save(sender, instance, created, *args, **kwargs):
+def user_post_save(sender, instance, created, using, *args, **kwargs):
+    cache.delete(user_cache_key(instance.id))
     if created:
-        try:
-            task_send_verify_user_email.delay(instance.id, instance.email)
-        except Exception as e:
-            logger.exception(e)
+        # written in the transaction creating the user, sent by task_drain_email_outbox once committed
+        EmailOutbox.objects.create(kind=EmailOutbox.VERIFY_USER, user=instance, email=instance.email)
+        drain_email_outbox_on_commit(using)
+        if len(settings.NOTE_SHARDS) > 1:
+            shard = UserShard.objects.create(user=instance, shard=assign_shard(instance.id)).shard
+            cache.set(shard_cache_key(instance.id), shard)
+
+
+def drain_email_outbox_on_commit(using=None):
+    """Start task_drain_email_outbox once the transaction commits, the beat schedule only catches up"""
+    # api.tasks imports the models
+    from api.tasks import task_drain_email_outbox
+    transaction.on_commit(task_drain_email_outbox.delay, using=using)
+
+
+def user_pre_delete(sender, instance, *args, **kwargs):
+    # read before the cascade drops the placement
+    instance.note_shard = shard_for_user(instance.id)
+
+
+def user_post_delete(sender, instance, using, *args, **kwargs):
+    cache.delete(user_cache_key(instance.id))
+    cache.delete(shard_cache_key(instance.id))
+    # the cascade only reaches the database of the user
+    if instance.note_shard != using:
+        Note.objects.using(instance.note_shard).filter(user_id=instance.id).delete()
+        Label.objects.using(instance.note_shard).filter(author_id=instance.id).delete()
 
 
 post_save.connect(user_post_save, sender=User)
+pre_delete.connect(user_pre_delete, sender=User)
+post_delete.connect(user_post_delete, sender=User)
+
+
+class UserShard(models.Model):
+    """Shard holding the notes and labels of a user, users without a row live on the first of NOTE_SHARDS"""
+    user = models.OneToOneField('api.User', on_delete=models.CASCADE, primary_key=True)
+    shard = models.CharField(max_length=100)
+
+    class Meta:
+        db_table = 'user_shard'
+        verbose_name = 'user shard'
+        verbose_name_plural = 'user shards'
+
+
+class EmailOutbox(models.Model):
+    """Emails waiting to be queued, one row per message, deleted once handed to the email queue"""
+    VERIFY_USER = 'verify_user'
+    FORGET_PASSWORD = 'forget_password'
+    KIND_CHOICES = (
+        (VERIFY_USER, 'verify user'),
+        (FORGET_PASSWORD, 'forget password'),
+    )
+    kind = models.CharField(max_length=50, choices=KIND_CHOICES)
+    user = models.ForeignKey('api.User', on_delete=models.CASCADE)
+    email = models.EmailField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'email_outbox'
+        verbose_name = 'email outbox'
+        verbose_name_plural = 'email outbox'
+        ordering = ['pk']
 
 
 class Note(models.Model):
     """ORM for all Notes"""
     title = models.CharField(max_length=255)
     description = models.TextField()
-    user = models.ForeignKey('api.User', on_delete=models.CASCADE)
+    # users live on the default database, their notes on any shard: no foreign key once there are several
+    user = models.ForeignKey('api.User', on_delete=models.CASCADE, db_constraint=len(settings.NOTE_SHARDS) == 1)
     color = models.CharField(max_length=255, null=True, blank=True)
     is_archived = models.BooleanField(default=False)
+    # weighted tsvector of title and description, maintained by a database trigger
+    search_vector = SearchVectorField(null=True, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = UserShardedManager()
 
     class Meta:
         db_table = 'note'
         verbose_name = 'note'
         verbose_name_plural = 'notes'
         ordering = ['pk']
+        indexes = [
+            GinIndex(fields=['search_vector'], name='note_search_vector_gin'),
+            models.Index(fields=['user', 'is_archived', 'id'], name='note_user_archived_id_idx'),
+            models.Index(fields=['user', 'color', 'id'], name='note_user_color_id_idx'),
+            models.Index(fields=['user', 'updated_at'], name='note_user_updated_at_idx'),
+        ]
 
 
 class Label(models.Model):
     """ORM for Label table"""
     title = models.CharField(max_length=255)
     color = models.CharField(max_length=50)
-    author = models.ForeignKey('api.User', on_delete=models.CASCADE)
+    author = models.ForeignKey('api.User', on_delete=models.CASCADE, db_constraint=len(settings.NOTE_SHARDS) == 1)
     is_archived = models.BooleanField(default=False)
-    # note = models.ManyToManyField('api.Note')
+    note = models.ManyToManyField('api.Note', through='api.NoteLabel', related_name='labels', blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = UserShardedManager()
 
     class Meta:
         db_table = 'label'
         verbose_name = 'label'
         verbose_name_plural = 'labels'
+        indexes = [
+            models.Index(fields=['author', 'is_archived', 'id'], name='label_author_archived_id_idx'),
+            models.Index(fields=['author', 'updated_at'], name='label_author_updated_at_idx'),
+        ]
+
+
+class NoteLabel(models.Model):
+    """Through table between Note and Label, indexed from both sides"""
+    note = models.ForeignKey('api.Note', on_delete=models.CASCADE)
+    label = models.ForeignKey('api.Label', on_delete=models.CASCADE)
+
+    class Meta:
+        db_table = 'note_label'
+        verbose_name = 'note label'
+        verbose_name_plural = 'note labels'
+        constraints = [
+            models.UniqueConstraint(fields=['note', 'label'], name='note_label_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['label', 'note'], name='note_label_label_note_idx'),
+        ]
+
+
+class Tombstone(models.Model):
+    """Deleted note or label, read by the delta sync until it is pruned"""
+    NOTE = 'note'
+    LABEL = 'label'
+    KIND_CHOICES = (
+        (NOTE, 'note'),
+        (LABEL, 'label'),
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    # not a foreign key, the rows of a deleted user are pruned with the others
+    user_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    objects = UserShardedManager()
+
+    class Meta:
+        db_table = 'tombstone'
+        verbose_name = 'tombstone'
+        verbose_name_plural = 'tombstones'
+        indexes = [
+            models.Index(fields=['user_id', 'deleted_at'], name='tombstone_user_deleted_idx'),
+        ]
+
+
+# tombstones of the deletes inside bulk_tombstones(), inserted together when it exits
+_pending_tombstones = ContextVar('pending_tombstones', default=None)
+
+
+@contextmanager
+def bulk_tombstones(using):
+    """Write the tombstones of the deletes of the block on ``using`` with one insert"""
+    pending = []
+    token = _pending_tombstones.set(pending)
+    try:
+        yield
+        Tombstone.objects.using(using).bulk_create(pending)
+    finally:
+        _pending_tombstones.reset(token)
+
+
+def add_tombstone(using, kind, object_id, user_id):
+    tombstone = Tombstone(kind=kind, object_id=object_id, user_id=user_id)
+    pending = _pending_tombstones.get()
+    if pending is None:
+        tombstone.save(using=using)
+    else:
+        pending.append(tombstone)
+
+
+def note_post_delete(sender, instance, using, *args, **kwargs):
+    add_tombstone(using, Tombstone.NOTE, instance.id, instance.user_id)
+
+
+def label_pre_delete(sender, instance, using, *args, **kwargs):
+    # the notes lose the label, the delta sync sends them again
+    Note.objects.using(using).filter(labels=instance).update(updated_at=timezone.now())
+
+
+def label_post_delete(sender, instance, using, *args, **kwargs):
+    add_tombstone(using, Tombstone.LABEL, instance.id, instance.author_id)
+
+
+post_delete.connect(note_post_delete, sender=Note)
+pre_delete.connect(label_pre_delete, sender=Label)
+post_delete.connect(label_post_delete, sender=Label)
@@ -0,0 +1,139 @@
+"""
+NDJSON export and import of the notes and labels of a user, one object
+per line tagged by ``type``, labels first. Both ends stream: the export
+reads server-side cursors and the import inserts in chunks, so memory does
+not grow with the number of notes.
+"""
+import json
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from api.cache import DataVersion, NoteCache
+from api.models import Label, Note, NoteLabel
+from api.renderers import FastJSONRenderer
+from api.sharding import shard_for_user
+
+CHUNK_SIZE = 2000
+# bytes of lines sent together
+BUFFER_SIZE = 64 * 1024
+
+LABEL_FIELDS = ('id', 'title', 'color', 'is_archived', 'created_at', 'updated_at')
+NOTE_FIELDS = ('id', 'title', 'description', 'color', 'is_archived', 'created_at', 'updated_at')
+
+
+def export_user_data(user_id, chunk_size=None):
+    """
+    Return an iterator of the NDJSON bytes of the user's labels and notes.
+    The querysets are bound to their database here, the rows are read while
+    the iterator is consumed.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    labels = Label.objects.for_user(user_id).order_by('pk').values(*LABEL_FIELDS)
+    notes = Note.objects.for_user(user_id).order_by('pk').values(*NOTE_FIELDS)
+    note_labels = (
+        NoteLabel.objects.using(notes.db).filter(note__user_id=user_id)
+        .order_by('note_id', 'label_id').values_list('note_id', 'label_id')
+    )
+    return stream_rows(labels.iterator(chunk_size), notes.iterator(chunk_size), note_labels.iterator(chunk_size))
+
+
+def stream_rows(labels, notes, note_labels):
+    renderer = FastJSONRenderer()
+    buffer = bytearray()
+    for row in rows(labels, notes, note_labels):
+        buffer += renderer.render(row)
+        buffer += b'\n'
+        if len(buffer) >= BUFFER_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def rows(labels, notes, note_labels):
+    for label in labels:
+        yield {'type': 'label', **label}
+    # both ordered by note id, merged as they are read
+    pair = next(note_labels, None)
+    for note in notes:
+        note['labels'] = []
+        while pair is not None and pair[0] <= note['id']:
+            if pair[0] == note['id']:
+                note['labels'].append(pair[1])
+            pair = next(note_labels, None)
+        yield {'type': 'note', **note}
+
+
+class Importer:
+    """
+    Insert the labels and notes of NDJSON lines as new rows of a user in one
+    transaction, ``chunk_size`` rows per bulk insert. Exported ids are only
+    used to link the notes to the labels of the same file.
+    """
+
+    def __init__(self, user_id, chunk_size=None):
+        self.user_id = user_id
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.shard = shard_for_user(user_id)
+        self.label_ids = {}
+        self.labels = []
+        self.notes = []
+        self.counts = {'labels': 0, 'notes': 0}
+
+    def run(self, lines):
+        with transaction.atomic(using=self.shard):
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                try:
+                    self.add(json.loads(line))
+                except (ValueError, TypeError, AttributeError, ValidationError) as e:
+                    raise ValueError(f'line {number}: {e}')
+            self.flush_notes()
+        NoteCache(self.user_id).rebuild()
+        DataVersion(self.user_id).bump()
+        return self.counts
+
+    def add(self, row):
+        if row.get('type') == 'label':
+            label = Label(
+                title=row.get('title'), color=row.get('color'), is_archived=row.get('is_archived', False),
+                author_id=self.user_id,
+            )
+            label.full_clean(exclude=('author', 'note'), validate_unique=False)
+            self.labels.append((row.get('id'), label))
+            if len(self.labels) >= self.chunk_size:
+                self.flush_labels()
+        elif row.get('type') == 'note':
+            note = Note(
+                title=row.get('title'), description=row.get('description'), color=row.get('color'),
+                is_archived=row.get('is_archived', False), user_id=self.user_id,
+            )
+            note.full_clean(exclude=('user', 'search_vector'), validate_unique=False)
+            self.notes.append((note, list(dict.fromkeys(row.get('labels') or ()))))
+            if len(self.notes) >= self.chunk_size:
+                self.flush_notes()
+        else:
+            raise ValueError(f"unknown type {row.get('type')!r}")
+
+    def flush_labels(self):
+        if self.labels:
+            Label.objects.using(self.shard).bulk_create([label for _, label in self.labels])
+            self.label_ids.update((exported_id, label.id) for exported_id, label in self.labels if exported_id is not None)
+            self.counts['labels'] += len(self.labels)
+            self.labels = []
+
+    def flush_notes(self):
+        self.flush_labels()
+        if not self.notes:
+            return
+        unknown = {label for _, labels in self.notes for label in labels} - self.label_ids.keys()
+        if unknown:
+            raise ValueError(f'notes refer to labels not in the file: {sorted(unknown, key=str)}')
+        Note.objects.using(self.shard).bulk_create([note for note, _ in self.notes])
+        NoteLabel.objects.using(self.shard).bulk_create([
+            NoteLabel(note_id=note.id, label_id=self.label_ids[label]) for note, labels in self.notes for label in labels
+        ])
+        self.counts['notes'] += len(self.notes)
+        self.notes = []
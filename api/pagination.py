@@ -0,0 +1,100 @@
+from bisect import bisect_right
+from operator import attrgetter, itemgetter
+
+from rest_framework.pagination import BasePagination
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from api.utils import ReturnResponse
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination keyed on the primary key. The cursor is the id of the
+    last row of the previous page, so a page is one indexed range scan and
+    stays stable while rows are added or removed.
+    """
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 500
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def get_cursor(self, request):
+        try:
+            return int(request.query_params[self.cursor_query_param])
+        except (KeyError, ValueError):
+            return None
+
+    def paginate(self, fetch, request, key):
+        """
+        Paginate rows returned by ``fetch(after, limit)``, ``key`` reads the
+        primary key of a row.
+        """
+        self.request = request
+        page_size = self.get_page_size(request)
+        return self.cut(fetch(self.get_cursor(request), page_size + 1), page_size, key)
+
+    async def apaginate(self, fetch, request, key):
+        """Same as paginate for an async ``fetch``"""
+        self.request = request
+        page_size = self.get_page_size(request)
+        return self.cut(await fetch(self.get_cursor(request), page_size + 1), page_size, key)
+
+    def cut(self, rows, page_size, key):
+        self.next_cursor = key(rows[page_size - 1]) if len(rows) > page_size else None
+        return rows[:page_size]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        def fetch(after, limit):
+            qs = queryset if after is None else queryset.filter(pk__gt=after)
+            return list(qs.order_by('pk')[:limit])
+
+        return self.paginate(fetch, request, key=attrgetter('pk'))
+
+    def paginate_values(self, queryset, request, serializer_class):
+        """Paginate rows read with the ``values`` fast path of ``serializer_class``"""
+        def fetch(after, limit):
+            qs = queryset if after is None else queryset.filter(pk__gt=after)
+            return serializer_class.values(qs.order_by('pk')[:limit])
+
+        return self.paginate(fetch, request, key=itemgetter('id'))
+
+    def paginate_rows(self, rows, request):
+        """Paginate dicts held in memory, sorted by id"""
+        ids = [row['id'] for row in rows]
+
+        def fetch(after, limit):
+            start = bisect_right(ids, after or 0)
+            return rows[start:start + limit]
+
+        return self.paginate(fetch, request, key=itemgetter('id'))
+
+    def paginate_cache(self, note_cache, request, **filters):
+        def fetch(after, limit):
+            return note_cache.page(after, limit, **filters)
+
+        return self.paginate(fetch, request, key=itemgetter('id'))
+
+    async def apaginate_cache(self, note_cache, request, **filters):
+        async def fetch(after, limit):
+            return await note_cache.page(after, limit, **filters)
+
+        return await self.apaginate(fetch, request, key=itemgetter('id'))
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return ReturnResponse(data=data, next=self.get_next_link())
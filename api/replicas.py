@@ -0,0 +1,139 @@
+"""
+Read replicas of the databases. DATABASE_REPLICAS maps a database alias to
+the aliases of its replicas. Reads go to a replica only inside
+``replica_reads()``, for a user who did not write in the last
+REPLICA_PIN_SECONDS, outside of transactions and to a replica at most
+REPLICA_MAX_LAG seconds behind; any other read, and every write, uses the
+primary.
+"""
+import logging
+import math
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# seconds the replica has not replayed yet, 0 when it replayed all it received
+LAG_SQL = """
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+
+_replica_reads = ContextVar('replica_reads', default=False)
+# replica alias: (monotonic time of the next check, lag in seconds)
+lags = {}
+
+
+def pin_key(user_id):
+    return f'primary:{user_id}'
+
+
+def pin_primary(user_id, pipe=None):
+    """Send the reads of given user to the primaries for REPLICA_PIN_SECONDS, queued on ``pipe`` when given"""
+    if settings.DATABASE_REPLICAS:
+        client = pipe if pipe is not None else get_redis_connection()
+        client.set(pin_key(user_id), 1, ex=settings.REPLICA_PIN_SECONDS)
+
+
+@contextmanager
+def replica_reads(user_id=None):
+    """Let the reads of the block use replicas, unless ``user_id`` is pinned to the primaries"""
+    allowed = bool(settings.DATABASE_REPLICAS)
+    if allowed and user_id is not None:
+        allowed = not get_redis_connection().exists(pin_key(user_id))
+    token = _replica_reads.set(allowed)
+    try:
+        yield allowed
+    finally:
+        _replica_reads.reset(token)
+
+
+def replica_view(view_func):
+    """Serve a read-only view method from the replicas"""
+
+    @wraps(view_func)
+    def wrapper(self, request, *args, **kwargs):
+        with replica_reads(request.user.id):
+            return view_func(self, request, *args, **kwargs)
+
+    return wrapper
+
+
+def read_db(alias):
+    """Return the database to read from for ``alias``, one of its replicas when allowed"""
+    if not _replica_reads.get() or connections[alias].in_atomic_block:
+        return alias
+    replicas = [
+        replica for replica in settings.DATABASE_REPLICAS.get(alias, ())
+        if replica_lag(replica) <= settings.REPLICA_MAX_LAG
+    ]
+    return random.choice(replicas) if replicas else alias
+
+
+def primary_for(alias):
+    """Return the primary of a replica alias, other aliases are returned as they are"""
+    for primary, replicas in settings.DATABASE_REPLICAS.items():
+        if alias in replicas:
+            return primary
+    return alias
+
+
+def replica_lag(alias):
+    """Return the lag of a replica in seconds, measured at most every REPLICA_LAG_CHECK_INTERVAL seconds"""
+    now = time.monotonic()
+    checked = lags.get(alias)
+    if checked is None or checked[0] <= now:
+        checked = lags[alias] = (now + settings.REPLICA_LAG_CHECK_INTERVAL, measure_lag(alias))
+    return checked[1]
+
+
+def measure_lag(alias):
+    """Ask a replica how far it is behind, an unreachable replica is infinitely behind"""
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(LAG_SQL)
+            lag = cursor.fetchone()[0]
+    except DatabaseError as e:
+        logger.warning('replica %s is unavailable: %s', alias, e)
+        return math.inf
+    # NULL before the replica replayed any transaction
+    return float(lag or 0)
+
+
+class ReplicaRouter:
+    """
+    Send the reads allowed by ``replica_reads()`` to a replica of ``default``
+    and keep writes of instances read from a replica on its primary.
+    Replicas are not migrated, they copy their primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if hints.get('instance') is not None:
+            return None
+        return read_db(DEFAULT_DB_ALIAS)
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db is not None:
+            return primary_for(instance._state.db)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if primary_for(obj1._state.db) == primary_for(obj2._state.db):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if primary_for(db) != db:
+            return False
+        return None
@@ -1,9 +1,56 @@
 from rest_framework import serializers
+from rest_framework.utils import model_meta
 
 from api.models import Label, Note, User
 
 
-class UserSerializer(serializers.ModelSerializer):
+class ValuesSerializerMixin:
+    """
+    Read-only fast path for model serializers made of plain model columns:
+    rows are read as ``values_list`` tuples and zipped with the readable
+    field names, skipping the per-field serialization of instances.
+    """
+
+    @classmethod
+    def value_fields(cls):
+        extra_kwargs = getattr(cls.Meta, 'extra_kwargs', {})
+        return tuple(name for name in cls.Meta.fields if not extra_kwargs.get(name, {}).get('write_only'))
+
+    @classmethod
+    def values(cls, queryset):
+        fields = cls.value_fields()
+        return [dict(zip(fields, row)) for row in queryset.values_list(*fields)]
+
+
+class UserShardSerializerMixin:
+    """
+    Create instances with Model.save, which asks the router for the shard
+    of the owner, instead of the manager that does not know the instance.
+    """
+
+    def create(self, validated_data):
+        info = model_meta.get_field_info(self.Meta.model)
+        many_to_many = {
+            name: validated_data.pop(name) for name, relation in info.relations.items()
+            if relation.to_many and name in validated_data
+        }
+        instance = self.Meta.model(**validated_data)
+        instance.save()
+        for name, value in many_to_many.items():
+            getattr(instance, name).set(value)
+        return instance
+
+
+class OwnerLabelsField(serializers.PrimaryKeyRelatedField):
+    """Label ids of the note owner, looked up on the owner's shard"""
+
+    def get_queryset(self):
+        root = self.root
+        user_id = getattr(root.instance, 'user_id', None) or getattr(root, 'initial_data', {}).get('user')
+        return Label.objects.for_user(int(user_id)) if user_id else Label.objects.none()
+
+
+class UserSerializer(ValuesSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'email', 'password', 'is_verified')
@@ -19,12 +66,20 @@ class UserSerializer(serializers.ModelSerializer):
         return instance
 
 
-class NoteSerializer(serializers.ModelSerializer):
+class NoteSerializer(UserShardSerializerMixin, serializers.ModelSerializer):
+    labels = OwnerLabelsField(many=True, required=False)
+
     class Meta:
         model = Note
-        fields = ('id', 'title', 'description', 'user', 'color', "is_archived")
+        fields = ('id', 'title', 'description', 'user', 'color', "is_archived", 'labels')
         read_only_fields = ('id',)
 
+    def validate(self, attrs):
+        user = attrs.get('user') or getattr(self.instance, 'user', None)
+        if any(label.author_id != getattr(user, 'id', None) for label in attrs.get('labels', [])):
+            raise serializers.ValidationError({'labels': 'Labels must belong to the note owner.'})
+        return attrs
+
 
 class NoteArchivedSerializer(serializers.ModelSerializer):
     class Meta:
@@ -40,8 +95,40 @@ class NoteUpdateColorSerializer(serializers.ModelSerializer):
         read_only_fields = ('id',)
 
 
-class LabelSerializer(serializers.ModelSerializer):
+class LabelSerializer(ValuesSerializerMixin, UserShardSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Label
         fields = ('id', 'title', 'color', 'author', "is_archived")
         read_only_fields = ('id', 'author')
+
+
+class NoteBulkOperationSerializer(serializers.Serializer):
+    """Validate one operation of a bulk note request against the serializer of its action"""
+    ACTION_SERIALIZERS = {
+        'create': NoteSerializer,
+        'update': NoteSerializer,
+        'archive': NoteArchivedSerializer,
+        'color': NoteUpdateColorSerializer,
+        'delete': None,
+    }
+
+    action = serializers.ChoiceField(choices=tuple(ACTION_SERIALIZERS))
+    id = serializers.IntegerField(required=False)
+    data = serializers.DictField(required=False, default=dict)
+
+    def validate(self, attrs):
+        action = attrs['action']
+        if action != 'create' and attrs.get('id') is None:
+            raise serializers.ValidationError({'id': f'This field is required for {action}.'})
+        serializer_class = self.ACTION_SERIALIZERS[action]
+        if serializer_class is not None:
+            data = dict(attrs['data'], user=self.context['request'].user.id)
+            serializer = serializer_class(data=data, partial=action == 'update')
+            serializer.is_valid(raise_exception=True)
+            attrs['data'] = serializer.validated_data
+            attrs['data'].pop('user', None)
+        return attrs
+
+
+class NoteBulkSerializer(serializers.Serializer):
+    operations = serializers.ListField(child=NoteBulkOperationSerializer(), allow_empty=False, max_length=500)
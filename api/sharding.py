@@ -0,0 +1,148 @@
+"""
+Placement of each user's notes and labels on one of the NOTE_SHARDS
+database aliases. A user created while several shards are configured is
+pinned to one by a UserShard row; users without a row live on the first
+shard. Queries name their shard with ``Model.objects.for_user(user_id)``,
+the router places saved and related instances next to their owner.
+"""
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, models
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.permissions import SAFE_METHODS, BasePermission
+
+from api.replicas import primary_for, read_db
+
+# sharded model: attribute holding the owner's user id
+OWNER_FIELDS = {
+    'note': 'user_id',
+    'label': 'author_id',
+    'notelabel': None,
+    'tombstone': 'user_id',
+}
+
+
+def shard_cache_key(user_id):
+    return f'shard:{user_id}'
+
+
+def moving_cache_key(user_id):
+    return f'shard-moving:{user_id}'
+
+
+def shard_for_user(user_id):
+    """Return the database alias holding the notes and labels of given user"""
+    shards = settings.NOTE_SHARDS
+    if len(shards) == 1:
+        return shards[0]
+    shard = cache.get(shard_cache_key(user_id))
+    if shard is None:
+        placement = apps.get_model('api', 'UserShard').objects.filter(user_id=user_id)
+        shard = placement.values_list('shard', flat=True).first() or shards[0]
+        cache.set(shard_cache_key(user_id), shard)
+    return shard
+
+
+class UserMoving(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Your notes are being moved, try again in a few seconds.'
+    default_code = 'user_moving'
+
+
+def check_writable(user_id):
+    """Raise UserMoving while rebalance_user moves the notes and labels of given user"""
+    if cache.get(moving_cache_key(user_id)):
+        raise UserMoving()
+
+
+class ShardWritable(BasePermission):
+    """Refuse the writes of a user being moved to another shard, reads go on"""
+
+    def has_permission(self, request, view):
+        if request.method not in SAFE_METHODS and request.user.is_authenticated:
+            check_writable(request.user.id)
+        return True
+
+
+def assign_shard(user_id):
+    """Pick the shard of a new user"""
+    return settings.NOTE_SHARDS[user_id % len(settings.NOTE_SHARDS)]
+
+
+def reserve_id_ranges(using, **kwargs):
+    """
+    post_migrate handler starting the id sequences of the sharded tables of
+    the i-th shard at i * NOTE_SHARD_ID_RANGE, so ids never collide and rows
+    keep their ids when a user moves to another shard
+    """
+    if using not in settings.NOTE_SHARDS:
+        return
+    start = settings.NOTE_SHARDS.index(using) * settings.NOTE_SHARD_ID_RANGE
+    if not start:
+        return
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        for model_name in OWNER_FIELDS:
+            table = apps.get_model('api', model_name)._meta.db_table
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+                sequence = cursor.fetchone()[0]
+                cursor.execute(f'SELECT last_value FROM {sequence}')
+                if cursor.fetchone()[0] < start:
+                    cursor.execute('SELECT setval(%s, %s, false)', [sequence, start])
+            elif connection.vendor == 'sqlite':
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s', [start - 1, table, start - 1])
+                cursor.execute(
+                    'INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s '
+                    'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+                    [table, start - 1, table],
+                )
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'api' and model._meta.model_name in OWNER_FIELDS
+
+
+class UserShardedManager(models.Manager):
+    """Manager of a model stored on the shard of its owner"""
+
+    def for_user(self, user_id):
+        """Query the shard of given user, one of its replicas inside ``replica_reads()``"""
+        owner_field = OWNER_FIELDS[self.model._meta.model_name]
+        return self.using(read_db(shard_for_user(user_id))).filter(**{owner_field: user_id})
+
+
+class UserShardRouter:
+    """
+    Route sharded models hinted with an instance: the instance's own
+    database, or the shard of its owner for new instances and for the
+    relations of a user. Queries without a hint use ``default``; every
+    database gets the whole schema.
+    """
+
+    def db_for_read(self, model, **hints):
+        return self.db_for_instance(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        db = self.db_for_instance(model, hints.get('instance'))
+        return None if db is None else primary_for(db)
+
+    @staticmethod
+    def db_for_instance(model, instance):
+        if instance is None or not is_sharded(model):
+            return None
+        if isinstance(instance, apps.get_model('api', 'User')):
+            return shard_for_user(instance.pk)
+        if not is_sharded(type(instance)):
+            return None
+        if instance._state.db is not None:
+            return instance._state.db
+        owner_field = OWNER_FIELDS[instance._meta.model_name]
+        return shard_for_user(getattr(instance, owner_field)) if owner_field else None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded(type(obj1)) or is_sharded(type(obj2)):
+            return True
+        return None
@@ -1,25 +1,133 @@
+import json
+from datetime import timedelta
+
 from celery import shared_task
 from django.conf import settings
-from django.core.mail import send_mail
-
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+from django_redis import get_redis_connection
 
+from api.models import EmailOutbox, Tombstone
 from api.utils import generate_jwt_token
 
+EMAIL_QUEUE_KEY = 'email:pending'
+
+
+def queue_email(subject, body, email):
+    queue_emails([(subject, body, email)])
+
+
+def queue_emails(messages):
+    """
+    Queue ``(subject, body, email)`` messages for task_send_pending_emails.
+    Filling an empty queue schedules a drain after EMAIL_BATCH_LATENCY
+    seconds, completing a full batch schedules it right away.
+    """
+    if not messages:
+        return
+    items = [json.dumps({'subject': subject, 'body': body, 'to': [email]}) for subject, body, email in messages]
+    pending = get_redis_connection().rpush(EMAIL_QUEUE_KEY, *items)
+    previous = pending - len(items)
+    if previous < settings.EMAIL_BATCH_SIZE <= pending:
+        task_send_pending_emails.delay()
+    elif previous == 0:
+        task_send_pending_emails.apply_async(countdown=settings.EMAIL_BATCH_LATENCY)
+
+
+def pop_email_batch(client, size):
+    pipe = client.pipeline()
+    pipe.lrange(EMAIL_QUEUE_KEY, 0, size - 1)
+    pipe.ltrim(EMAIL_QUEUE_KEY, size, -1)
+    return pipe.execute()[0]
+
+
+@shared_task(bind=True, max_retries=None)
+def task_send_pending_emails(self):
+    """
+    Send queued messages in batches of EMAIL_BATCH_SIZE over one SMTP
+    connection, opened only when there is something to send. On a failure
+    the messages not sent yet go back to the queue and the drain is
+    retried, backing off up to EMAIL_RETRY_MAX_DELAY seconds.
+    """
+    client = get_redis_connection()
+    size = settings.EMAIL_BATCH_SIZE
+    batch = pop_email_batch(client, size)
+    if not batch:
+        return 0
+    sent = 0
+    with get_connection() as connection:
+        while batch:
+            for index, item in enumerate(batch):
+                message = EmailMessage(from_email=settings.EMAIL_HOST_USER, connection=connection, **json.loads(item))
+                try:
+                    # one message at a time, a failure never sends a delivered message again
+                    sent += connection.send_messages([message]) or 0
+                except Exception as e:
+                    client.lpush(EMAIL_QUEUE_KEY, *reversed(batch[index:]))
+                    countdown = min(settings.EMAIL_BATCH_LATENCY * 2 ** self.request.retries, settings.EMAIL_RETRY_MAX_DELAY)
+                    raise self.retry(exc=e, countdown=countdown)
+            batch = pop_email_batch(client, size)
+    return sent
+
 
 @shared_task
-def task_send_forget_password_email(user_id, email):
+def task_drain_email_outbox():
+    """
+    Move committed EmailOutbox rows to the email queue, EMAIL_BATCH_SIZE rows
+    per transaction. Rows are deleted in the transaction that queued them, a
+    failure leaves them for the next run; concurrent drains skip locked rows.
+    """
+    size = settings.EMAIL_BATCH_SIZE
+    drained = 0
+    while True:
+        with transaction.atomic():
+            rows = list(EmailOutbox.objects.select_for_update(skip_locked=True)[:size])
+            if not rows:
+                break
+            queue_emails([(*OUTBOX_RENDERERS[row.kind](row.user_id, row.email), row.email) for row in rows])
+            EmailOutbox.objects.filter(pk__in=[row.pk for row in rows]).delete()
+        drained += len(rows)
+    return drained
+
+
+def render_forget_password_email(user_id, email):
     endpoint = f"{settings.SITE_URI}/api/auth/{generate_jwt_token(user_id)}/update_password/"
     subject = "Change your password"
     body = f"Hii, {email}\n"
     body += f"use this link to change your password\n{endpoint}"
-    send_mail(subject, body, settings.EMAIL_HOST_USER, [email], fail_silently=False)
-    return 'send_forget_password_task'
+    return subject, body
 
 
-@shared_task
-def task_send_verify_user_email(user_id, email):
+def render_verify_user_email(user_id, email):
     endpoint = f"{settings.SITE_URI}/api/auth/{generate_jwt_token(user_id)}/verify_user/"
     subject = "New user Verification Notifier"
     body = f"Try this link to verify your account\n{endpoint}/"
-    send_mail(subject, body, settings.EMAIL_HOST_USER, [email], fail_silently=False)
+    return subject, body
+
+
+OUTBOX_RENDERERS = {
+    EmailOutbox.VERIFY_USER: render_verify_user_email,
+    EmailOutbox.FORGET_PASSWORD: render_forget_password_email,
+}
+
+
+@shared_task
+def task_send_forget_password_email(user_id, email):
+    queue_email(*render_forget_password_email(user_id, email), email)
+    return 'send_forget_password_task'
+
+
+@shared_task
+def task_send_verify_user_email(user_id, email):
+    queue_email(*render_verify_user_email(user_id, email), email)
     return 'send_email_to_verify_user_task'
+
+
+@shared_task
+def task_prune_tombstones():
+    """Delete tombstones older than SYNC_TOMBSTONE_DAYS on every shard"""
+    horizon = timezone.now() - timedelta(days=settings.SYNC_TOMBSTONE_DAYS)
+    return sum(
+        Tombstone.objects.using(shard).filter(deleted_at__lt=horizon).delete()[0] for shard in settings.NOTE_SHARDS
+    )
@@ -1,11 +1,48 @@
-from django.test import TestCase
+import asyncio
+import csv
+import json
+import os
+import pickle
+import tempfile
+import time
+from io import StringIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import sync_to_async
+from celery.exceptions import Retry
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.core.mail import get_connection
+from django.core.mail.backends.locmem import EmailBackend
+from django.db import connection, connections, transaction
+from django.db.models import QuerySet
+from django_redis import get_redis_connection
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
-from django.core.cache import cache
-from django_fakeredis.fakeredis import FakeRedis
+from rest_framework_simplejwt.tokens import AccessToken
+from redis import Redis
+from django_fakeredis.fakeredis import FakeRedis, get_fake_redis, server as fake_redis_server
+from fakeredis.aioredis import FakeRedis as AsyncFakeRedis
 
-from api.models import User
+from api.cache import DataVersion, NoteCache, get_async_redis_connection
+from api.cache_serializers import CacheCodec, MsgpackSerializer, PickleSerializer
+from api.local_cache import INVALIDATION_CHANNEL, local_cache
+from api.management.commands.benchmark import Benchmark, Command as BenchmarkCommand
+from api.management.commands.rebalance_user import Command as RebalanceCommand
+from api.management.commands.warm_note_cache import CURSOR_KEY
+from api.metrics import metrics
+from api.models import EmailOutbox, Label, Note, NoteLabel, Tombstone, User, UserShard
+from api.renderers import FastJSONRenderer
+from api.replicas import lags as replica_lags, pin_key
+from api.serializers import LabelSerializer, UserSerializer
+from api.sharding import assign_shard, moving_cache_key, shard_cache_key, shard_for_user
+from api.tasks import EMAIL_QUEUE_KEY, task_drain_email_outbox, task_send_pending_emails, task_send_verify_user_email
+from api.throttling import TOKEN_BUCKET_LUA
 
 # user_details = {"username": "user1", "email": "user@email.com", "password": "password"}
 # superuser_details = {"username": "sups", "email": "admin@email.com", "password": "password"}
@@ -24,14 +61,17 @@ def create_superuser(**params):
     return User.objects.create_superuser(**params)
 
 
+def generate_access_token(user):
+    return str(AccessToken.for_user(user))
+
+
 class TestUserAccessibleApiView(TestCase):
     def setUp(self) -> None:
         self.client = APIClient()
 
     @staticmethod
     def remove_cache(user_id):
-        if cache.get(user_id):
-            cache.delete(user_id)
+        NoteCache(user_id).clear()
 
     def test_end_points_are_accessible_by_appropriate_user(self):
         """
@@ -64,7 +104,7 @@ class TestUserAccessibleApiView(TestCase):
         res = anonymous_client.get(ENDPOINT_USER_LIST)
         self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
 
-    @FakeRedis("redis://127.0.0.1:6379/")
+    @FakeRedis("api.cache.get_redis_connection")
     def test_notes_api_crud_operation(self):
         """
         Test Get, Post, Put, Delete operations working condition
@@ -88,4 +128,1122 @@ class TestUserAccessibleApiView(TestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(payload['title'], response.data['data']['title'])
         self.assertEqual(payload['description'], response.data['data']['description'])
+        note_id = response.data['data']['id']
+
+        # Put Response update()
+        payload = {'title': "test note 002", "description": "test description 002", 'user': user.id}
+        response = self.client.put(f'{ENDPOINT_NOTE_LIST}{note_id}/', payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Get Response retrieve() served from the note cache
+        response = self.client.get(f'{ENDPOINT_NOTE_LIST}{note_id}/', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['data']['title'], "test note 002")
+        self.assertEqual(len(NoteCache(user.id).all()), 1)
+
+        # Delete Response destroy()
+        response = self.client.delete(f'{ENDPOINT_NOTE_LIST}{note_id}/', format='json')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertIsNone(NoteCache(user.id).get(note_id))
+        self.remove_cache(user.id)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_notes_cache_is_rebuilt_on_miss(self):
+        """
+        Test list() and retrieve() read through to the database on cache miss
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        note = Note.objects.create(title="test note 001", description="test description 001", user=user)
+
+        login_res = self.client.post(ENDPOINT_LOGIN, {"email": "user@email.com", "password": "password"})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + login_res.data['access'])
+        self.remove_cache(user.id)
+
+        response = self.client.get(f'{ENDPOINT_NOTE_LIST}{note.id}/', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['data']['title'], note.title)
+
         self.remove_cache(user.id)
+        response = self.client.get(ENDPOINT_NOTE_LIST, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()['data']), 1)
+
+        # A built cache is served without touching the database
+        with self.assertNumQueries(0):
+            self.assertEqual(len(NoteCache(user.id).all()), 1)
+        self.remove_cache(user.id)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_notes_cache_rebuild_keeps_concurrent_writes(self):
+        """
+        Test a note written through while the cache is rebuilt is not overwritten by the rebuild
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        first = Note.objects.create(title="note 1", description="description", user=user)
+        self.remove_cache(user.id)
+        note_cache = NoteCache(user.id)
+        build, written = note_cache.build, []
+
+        def build_during_write(notes):
+            dataset = build(notes)
+            if not written:
+                written.append(Note.objects.create(title="note 2", description="description", user=user))
+                NoteCache(user.id).set(written[0])
+            return dataset
+
+        with mock.patch.object(note_cache, 'build', side_effect=build_during_write) as rebuilt:
+            self.assertEqual(sorted(note_cache.load()), [first.id, written[0].id])
+        self.assertEqual(rebuilt.call_count, 2)
+        self.assertEqual([note['id'] for note in NoteCache(user.id).all()], [first.id, written[0].id])
+        self.remove_cache(user.id)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_notes_write_through_stores_the_last_committed_row(self):
+        """
+        Test a write-through racing a later write of the same note keeps the row committed last
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        note = Note.objects.create(title="first", description="description", user=user)
+        self.remove_cache(user.id)
+        NoteCache(user.id).all()
+        note_cache = NoteCache(user.id)
+        build, written = note_cache.build, []
+
+        def build_during_write(notes):
+            dataset = build(notes)
+            if not written:
+                written.append(Note.objects.filter(pk=note.id).update(title="second"))
+                NoteCache(user.id).set(note)
+            return dataset
+
+        with mock.patch.object(note_cache, 'build', side_effect=build_during_write) as patched:
+            note_cache.set(note)
+        self.assertEqual(patched.call_count, 2)
+        self.assertEqual(NoteCache(user.id).get(note.id)['title'], "second")
+
+        # a note deleted meanwhile is removed, not written back
+        Note.objects.filter(pk=note.id).delete()
+        NoteCache(user.id).set(note)
+        self.assertIsNone(NoteCache(user.id).get(note.id))
+
+        # notes changing on every read leave no cache behind
+        other = Note.objects.create(title="other", description="description", user=user)
+        NoteCache(user.id).all()
+
+        def build_always_racing(notes):
+            DataVersion(user.id).bump()
+            return build(notes)
+
+        with mock.patch.object(note_cache, 'build', side_effect=build_always_racing) as patched:
+            note_cache.set(other)
+        self.assertEqual(patched.call_count, NoteCache.rebuild_retries)
+        self.assertFalse(note_cache.client.exists(note_cache.key))
+        self.assertEqual([data['id'] for data in NoteCache(user.id).all()], [other.id])
+        self.remove_cache(user.id)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_notes_list_is_paginated_by_cursor(self):
+        """
+        Test list() returns pages of notes linked by the next cursor
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        notes = [Note.objects.create(title=f"note {i}", description="description", user=user) for i in range(5)]
+
+        login_res = self.client.post(ENDPOINT_LOGIN, {"email": "user@email.com", "password": "password"})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + login_res.data['access'])
+        self.remove_cache(user.id)
+
+        ids, url = [], f'{ENDPOINT_NOTE_LIST}?page_size=2'
+        while url:
+            response = self.client.get(url, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.json()['data']), 2)
+            ids += [item['id'] for item in response.json()['data']]
+            url = response.json()['next']
+        self.assertEqual(ids, [note.id for note in notes])
+        self.remove_cache(user.id)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_notes_bulk_operations(self):
+        """
+        Test bulk() applies a batch of operations and patches the note cache once
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        first, second = [Note.objects.create(title=f"note {i}", description="description", user=user) for i in range(2)]
+        label = Label.objects.create(title="label 1", color="red", author=user)
+
+        login_res = self.client.post(ENDPOINT_LOGIN, {"email": "user@email.com", "password": "password"})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + login_res.data['access'])
+        self.remove_cache(user.id)
+
+        payload = {'operations': [
+            {'action': 'create', 'data': {'title': "note 2", 'description': "description", 'labels': [label.id]}},
+            {'action': 'update', 'id': first.id, 'data': {'title': "note 0 updated", 'labels': [label.id]}},
+            {'action': 'archive', 'id': first.id, 'data': {'is_archived': True}},
+            {'action': 'color', 'id': first.id, 'data': {'color': "red"}},
+            {'action': 'delete', 'id': second.id},
+        ]}
+        response = self.client.post(reverse('notes-bulk'), payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['data']['created']), 1)
+        self.assertEqual(response.data['data']['created'][0]['labels'], [label.id])
+        self.assertEqual(response.data['data']['updated'][0]['labels'], [label.id])
+        self.assertEqual(response.data['data']['deleted'], [second.id])
+
+        first.refresh_from_db()
+        self.assertEqual((first.title, first.is_archived, first.color), ("note 0 updated", True, "red"))
+        self.assertFalse(Note.objects.filter(pk=second.id).exists())
+
+        response = self.client.get(ENDPOINT_NOTE_LIST, format='json')
+        self.assertEqual([item['title'] for item in response.json()['data']], ["note 0 updated", "note 2"])
+
+        # Unknown note ids reject the whole batch
+        payload = {'operations': [
+            {'action': 'create', 'data': {'title': "note 3", 'description': "description"}},
+            {'action': 'delete', 'id': second.id},
+        ]}
+        response = self.client.post(reverse('notes-bulk'), payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Note.objects.filter(user=user).count(), 2)
+        self.remove_cache(user.id)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_notes_bulk_writes_only_the_fields_sent(self):
+        """
+        Test bulk() keeps the changes another request made to fields an operation did not send
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        first, second = [Note.objects.create(title=f"note {i}", description="description", user=user) for i in range(2)]
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + generate_access_token(user))
+        self.remove_cache(user.id)
+        in_bulk = QuerySet.in_bulk
+
+        def in_bulk_then_concurrent_write(queryset, *args, **kwargs):
+            notes = in_bulk(queryset, *args, **kwargs)
+            Note.objects.filter(pk=first.id).update(title="changed meanwhile")
+            return notes
+
+        payload = {'operations': [
+            {'action': 'color', 'id': first.id, 'data': {'color': "red"}},
+            {'action': 'update', 'id': second.id, 'data': {'title': "note 1 updated"}},
+        ]}
+        with mock.patch.object(QuerySet, 'in_bulk', autospec=True, side_effect=in_bulk_then_concurrent_write):
+            response = self.client.post(reverse('notes-bulk'), payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        first.refresh_from_db()
+        self.assertEqual((first.title, first.color), ("changed meanwhile", "red"))
+        self.assertEqual(Note.objects.get(pk=second.id).title, "note 1 updated")
+        self.remove_cache(user.id)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_notes_bulk_delete_writes_tombstones_in_bulk(self):
+        """
+        Test bulk() deletes notes, their labels and writes their tombstones with one statement per table
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        label = Label.objects.create(title="label 1", color="red", author=user)
+        notes = [Note.objects.create(title=f"note {i}", description="description", user=user) for i in range(3)]
+        for note in notes:
+            note.labels.add(label)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + generate_access_token(user))
+        self.remove_cache(user.id)
+
+        payload = {'operations': [{'action': 'delete', 'id': note.id} for note in notes]}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('notes-bulk'), payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        statements = [query['sql'].split(' WHERE ')[0] for query in queries]
+        for statement in ('DELETE FROM "note"', 'DELETE FROM "note_label"'):
+            self.assertEqual(statements.count(statement), 1, statement)
+        self.assertEqual(sum(statement.startswith('INSERT INTO "tombstone"') for statement in statements), 1)
+        self.assertFalse(Note.objects.filter(user=user).exists())
+        self.assertFalse(NoteLabel.objects.filter(label=label).exists())
+        self.assertEqual(
+            sorted(Tombstone.objects.filter(user_id=user.id, kind=Tombstone.NOTE).values_list('object_id', flat=True)),
+            [note.id for note in notes],
+        )
+        self.remove_cache(user.id)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_notes_are_exported_and_imported_as_ndjson(self):
+        """
+        Test export() streams labels then notes with their labels and import_data() adds them to another user
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        other = create_user(username="user2", email="other@email.com", password="password")
+        labels = [Label.objects.create(title=f"label {i}", color="red", author=user) for i in range(2)]
+        for i in range(3):
+            note = Note.objects.create(title=f"note {i}", description="description", user=user)
+            note.labels.set(labels[:i])
+        self.remove_cache(other.id)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + generate_access_token(user))
+        with mock.patch('api.ndjson.BUFFER_SIZE', 100):
+            response = self.client.get(reverse('notes-export'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 1)
+        rows = [json.loads(line) for line in b''.join(chunks).splitlines()]
+        self.assertEqual([row['type'] for row in rows], ['label', 'label', 'note', 'note', 'note'])
+        self.assertEqual([row['labels'] for row in rows[2:]], [[], [labels[0].id], [labels[0].id, labels[1].id]])
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + generate_access_token(other))
+        NoteCache(other.id).all()
+        body = b''.join(chunks)
+        with mock.patch('api.ndjson.CHUNK_SIZE', 2):
+            response = self.client.post(reverse('notes-import'), body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['data'], {'labels': 2, 'notes': 3})
+        imported = NoteCache(other.id).all()
+        self.assertEqual([note['title'] for note in imported], ["note 0", "note 1", "note 2"])
+        self.assertEqual([len(note['labels']) for note in imported], [0, 1, 2])
+        self.assertFalse(set(imported[2]['labels']) & {label.id for label in labels})
+
+        # a bad line rolls the whole import back
+        response = self.client.post(
+            reverse('notes-import'), body + b'{"type": "note", "title": null}\n', content_type='application/x-ndjson'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('line 6', response.data['message'])
+        self.assertEqual(Note.objects.filter(user=other).count(), 3)
+        self.remove_cache(other.id)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_authentication_is_served_from_cache(self):
+        """
+        Test authenticated reads hit neither the database nor a stale user after save
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        login_res = self.client.post(ENDPOINT_LOGIN, {"email": "user@email.com", "password": "password"})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + login_res.data['access'])
+        self.remove_cache(user.id)
+
+        self.client.get(ENDPOINT_NOTE_LIST, format='json')
+        with self.assertNumQueries(0):
+            response = self.client.get(ENDPOINT_NOTE_LIST, format='json')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        # Saving the user drops the cached copy
+        user.is_verified = True
+        user.save()
+        with self.assertNumQueries(1):
+            self.client.get(ENDPOINT_NOTE_LIST, format='json')
+        self.remove_cache(user.id)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_notes_are_filtered_by_label(self):
+        """
+        Test label ids are embedded in notes and list() filters notes by label
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        label = Label.objects.create(title="label 1", color="red", author=user)
+
+        login_res = self.client.post(ENDPOINT_LOGIN, {"email": "user@email.com", "password": "password"})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + login_res.data['access'])
+        self.remove_cache(user.id)
+
+        payload = {'title': "labelled", "description": "description", 'labels': [label.id]}
+        labelled = self.client.post(ENDPOINT_NOTE_LIST, payload, format='json').data['data']
+        self.assertEqual(labelled['labels'], [label.id])
+        payload = {'title': "plain", "description": "description"}
+        self.client.post(ENDPOINT_NOTE_LIST, payload, format='json')
+
+        response = self.client.get(f'{ENDPOINT_NOTE_LIST}?label={label.id}', format='json')
+        self.assertEqual([item['id'] for item in response.json()['data']], [labelled['id']])
+        self.assertEqual(response.json()['data'][0]['labels'], [label.id])
+
+        # Deleting the label drops it from the cached notes
+        self.client.delete(f'{ENDPOINT_LABEL_LIST}{label.id}/', format='json')
+        self.assertEqual(NoteCache(user.id).get(labelled['id'])['labels'], [])
+        self.remove_cache(user.id)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_notes_are_filtered_by_archived_and_color(self):
+        """
+        Test list() serves active and archived partitions and filters by color
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        active = Note.objects.create(title="active", description="description", color="red", user=user)
+        archived = Note.objects.create(title="archived", description="description", user=user, is_archived=True)
+
+        login_res = self.client.post(ENDPOINT_LOGIN, {"email": "user@email.com", "password": "password"})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + login_res.data['access'])
+        self.remove_cache(user.id)
+
+        def listed(query):
+            response = self.client.get(f'{ENDPOINT_NOTE_LIST}?{query}', format='json')
+            if response.status_code == status.HTTP_204_NO_CONTENT:
+                return []
+            return [item['id'] for item in response.json()['data']]
+
+        self.assertEqual(listed('archived=false'), [active.id])
+        self.assertEqual(listed('archived=true'), [archived.id])
+        self.assertEqual(listed('color=red'), [active.id])
+        self.assertEqual(listed('color=red&archived=true'), [])
+
+        # Archiving moves the note between partitions
+        self.client.put(f'/api/note-archive/{active.id}/', {'is_archived': True}, format='json')
+        self.assertEqual(listed('archived=false'), [])
+        self.assertEqual(listed('archived=true'), [active.id, archived.id])
+        self.assertEqual(listed(''), [active.id, archived.id])
+
+        response = self.client.get(f'{ENDPOINT_NOTE_LIST}?archived=maybe', format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.remove_cache(user.id)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_note_and_label_listing_answer_conditional_get(self):
+        """
+        Test list() returns 304 for a current ETag and a new ETag after any write
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        Note.objects.create(title="note", description="description", user=user)
+
+        login_res = self.client.post(ENDPOINT_LOGIN, {"email": "user@email.com", "password": "password"})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + login_res.data['access'])
+        self.remove_cache(user.id)
+
+        etag = self.client.get(ENDPOINT_NOTE_LIST, format='json')['ETag']
+        response = self.client.get(ENDPOINT_NOTE_LIST, HTTP_IF_NONE_MATCH=etag, format='json')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.client.post(ENDPOINT_LABEL_LIST, {'title': "label", 'color': "red"}, format='json')
+        response = self.client.get(ENDPOINT_NOTE_LIST, HTTP_IF_NONE_MATCH=etag, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+        etag = response['ETag']
+        response = self.client.get(ENDPOINT_LABEL_LIST, HTTP_IF_NONE_MATCH=etag, format='json')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.remove_cache(user.id)
+
+    def test_notes_list_is_served_rendered_until_a_note_changes(self):
+        """
+        Test list() sends back the cached body and drops it when a note is written
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        note = Note.objects.create(title='note', description='note', user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + generate_access_token(user))
+        self.remove_cache(user.id)
+        first = self.client.get(f'{ENDPOINT_NOTE_LIST}?page_size=10')
+        with mock.patch.object(NoteCache, 'page') as page, self.assertNumQueries(0):
+            second = self.client.get(f'{ENDPOINT_NOTE_LIST}?page_size=10')
+        page.assert_not_called()
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(second['Content-Type'], 'application/json')
+        for header in ('Vary', 'Allow'):
+            self.assertEqual(second[header], first[header])
+        self.assertIn('Accept', second['Vary'])
+
+        # parameters the page does not depend on share the body, the number of bodies is capped
+        with mock.patch.object(NoteCache, 'page') as page:
+            self.assertEqual(self.client.get(f'{ENDPOINT_NOTE_LIST}?page_size=10&utm_source=x').content, first.content)
+        page.assert_not_called()
+        with mock.patch.object(NoteCache, 'rendered_max_fields', 1):
+            self.client.get(f'{ENDPOINT_NOTE_LIST}?page_size=5')
+        self.assertEqual(get_redis_connection().hlen(NoteCache(user.id).rendered_key), 1)
+
+        self.client.put(f'{ENDPOINT_NOTE_LIST}{note.id}/', {'title': 'changed', 'description': 'note', 'user': user.id}, format='json')
+        response = self.client.get(f'{ENDPOINT_NOTE_LIST}?page_size=10')
+        self.assertEqual([item['title'] for item in response.json()['data']], ['changed'])
+
+    def test_values_fast_path_matches_serializers(self):
+        """
+        Test the values fast path and the fast renderer produce the serializer output
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        Label.objects.create(title='label', color='red', author=user)
+        Label.objects.create(title='label ü', color='blue', author=user, is_archived=True)
+        for serializer_class, queryset in ((LabelSerializer, Label.objects.order_by('pk')),
+                                           (UserSerializer, User.objects.order_by('pk'))):
+            expected = serializer_class(queryset, many=True).data
+            self.assertEqual(serializer_class.values(queryset), expected)
+            self.assertEqual(json.loads(FastJSONRenderer().render({'data': expected})), {'data': expected})
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + generate_access_token(user))
+        response = self.client.get(ENDPOINT_LABEL_LIST)
+        self.assertEqual(response.json()['data'], LabelSerializer(Label.objects.order_by('pk'), many=True).data)
+
+    def test_changes_returns_rows_changed_since_cursor(self):
+        """
+        Test changes() sends everything first, then only what changed and tombstones
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        kept = Note.objects.create(title='kept', description='note', user=user)
+        removed = Note.objects.create(title='removed', description='note', user=user)
+        label = Label.objects.create(title='label', color='red', author=user)
+        labelled = Note.objects.create(title='labelled', description='note', user=user)
+        labelled.labels.add(label)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + generate_access_token(user))
+        endpoint = reverse('notes-changes')
+
+        with self.settings(SYNC_CURSOR_OVERLAP=0):
+            response = self.client.get(endpoint)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.data['data']
+            self.assertTrue(data['reset'])
+            self.assertEqual([note['id'] for note in data['notes']], [kept.id, removed.id, labelled.id])
+            self.assertEqual([item['id'] for item in data['labels']], [label.id])
+
+            self.client.put(f'{ENDPOINT_NOTE_LIST}{kept.id}/', {
+                'title': 'changed', 'description': 'note', 'user': user.id,
+            }, format='json')
+            self.client.delete(f'{ENDPOINT_NOTE_LIST}{removed.id}/')
+            self.client.delete(f'{ENDPOINT_LABEL_LIST}{label.id}/')
+            data = self.client.get(endpoint, {'since': data['cursor']}).data['data']
+
+        self.assertFalse(data['reset'])
+        self.assertEqual([(note['id'], note['labels']) for note in data['notes']], [(kept.id, []), (labelled.id, [])])
+        self.assertEqual(data['labels'], [])
+        self.assertEqual(data['deleted'], {'notes': [removed.id], 'labels': [label.id]})
+
+
+class TestAsyncViews(TestCase):
+    def test_async_redis_client_is_bound_to_its_event_loop(self):
+        """
+        Test every event loop gets its own asyncio Redis client, reused within the loop
+        """
+        async def clients():
+            return get_async_redis_connection(), get_async_redis_connection()
+
+        with mock.patch('api.cache.AsyncRedis.from_url', side_effect=lambda url: object()):
+            first, again = asyncio.run(clients())
+            second, _ = asyncio.run(clients())
+        self.assertIs(first, again)
+        self.assertIsNot(first, second)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    async def test_async_notes_api_crud_operation(self):
+        """
+        Test the async note endpoints share the note cache with the sync ones
+        """
+        user = await sync_to_async(create_user)(username="user1", email="user@email.com", password="password")
+        token = await sync_to_async(generate_access_token)(user)
+        client, auth = AsyncClient(), {'AUTHORIZATION': 'Bearer ' + token}
+        async_redis = AsyncFakeRedis(server=fake_redis_server)
+        endpoint = reverse('async-notes-list')
+
+        with mock.patch('api.cache.get_async_redis_connection', return_value=async_redis):
+            await sync_to_async(NoteCache(user.id).clear)()
+            response = await client.get(endpoint, **auth)
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+            payload = {'title': "test note 001", "description": "test description 001"}
+            response = await client.post(endpoint, payload, content_type='application/json', **auth)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            note_id = response.json()['data']['id']
+
+            payload = {'title': "test note 002", "description": "test description 002"}
+            detail = reverse('async-notes-detail', args=[note_id])
+            response = await client.put(detail, payload, content_type='application/json', **auth)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            response = await client.get(detail, **auth)
+            self.assertEqual(response.json()['data']['title'], "test note 002")
+            cached = await sync_to_async(NoteCache(user.id).get)(note_id)
+            self.assertEqual(cached['title'], "test note 002")
+
+            response = await client.delete(detail, **auth)
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            response = await client.get(detail, **auth)
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+            response = await client.get(endpoint)
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+            await sync_to_async(NoteCache(user.id).clear)()
+
+
+class TestSearch(TestCase):
+    def setUp(self) -> None:
+        self.client = APIClient()
+
+    @skipUnless(connection.vendor == 'postgresql', 'full text search needs PostgreSQL')
+    def test_notes_full_text_search(self):
+        """
+        Test search() matches words by prefix and ranks title matches first
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        body = Note.objects.create(title="groceries", description="buy apples and oranges", user=user)
+        title = Note.objects.create(title="apple pie recipe", description="flour, butter", user=user)
+        Note.objects.create(title="meeting", description="quarterly planning", user=user)
+
+        login_res = self.client.post(ENDPOINT_LOGIN, {"email": "user@email.com", "password": "password"})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + login_res.data['access'])
+
+        response = self.client.get(f"{reverse('notes-search')}?q=appl", format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['id'] for item in response.data['data']], [title.id, body.id])
+
+        response = self.client.get(f"{reverse('notes-search')}?q=", format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestBenchmark(TestCase):
+    def test_benchmark_workloads_succeed(self):
+        """
+        Test the benchmark command drives every workload without errors
+        """
+        results = Benchmark(users=2, notes=3, labels=1, rounds=1).run()
+        self.assertEqual(results['requests'], 24)
+        for name, row in results['endpoints'].items():
+            self.assertEqual(row['errors'], 0, name)
+            self.assertEqual(row['requests'], 2, name)
+
+    @mock.patch('api.throttling.get_redis_connection', get_fake_redis)
+    def test_default_benchmark_is_not_throttled(self):
+        """
+        Test the default benchmark run stays under the throttle rates of the auth and note write routes
+        """
+        results = Benchmark().run()
+        self.assertEqual(results['endpoints']['register']['requests'], 50)
+        self.assertEqual({name: row['errors'] for name, row in results['endpoints'].items() if row['errors']}, {})
+
+    def test_redis_benchmark_runs_in_its_own_database_and_removes_its_keys(self):
+        """
+        Test --redis moves the caches to --redis-db, refuses a database in use and flushes it after the run
+        """
+        caches = BenchmarkCommand.redis_caches(15)
+        self.assertEqual(caches['default']['LOCATION'], 'redis://127.0.0.1:6379/15')
+        client = get_fake_redis()
+        client.flushall()
+        client.set('notes:1', 'real user')
+        output = os.path.join(tempfile.mkdtemp(), 'benchmark.json')
+
+        def benchmark(options):
+            client.set('notes:1', 'benchmark user')
+            return {'requests': 0, 'elapsed_s': 0, 'rps': None, 'endpoints': {}}
+
+        with mock.patch('api.management.commands.benchmark.get_redis_connection', get_fake_redis), \
+                mock.patch.object(BenchmarkCommand, 'benchmark', side_effect=benchmark):
+            with self.assertRaises(CommandError):
+                call_command('benchmark', '--redis', '--output', output, stdout=StringIO())
+            self.assertEqual(client.get('notes:1'), b'real user')
+
+            client.flushall()
+            call_command('benchmark', '--redis', '--output', output, stdout=StringIO())
+        self.assertEqual(client.dbsize(), 0)
+        with open(output) as f:
+            self.assertEqual(json.load(f)['redis'], 'redis')
+
+
+class TestMetrics(TestCase):
+    def setUp(self) -> None:
+        self.client = APIClient()
+
+    def test_metrics_are_exposed_per_route(self):
+        """
+        Test requests and note cache reads show up in the Prometheus metrics
+        """
+        metrics.reset()
+        user = create_user(username="user1", email="user@email.com", password="password")
+        Note.objects.create(title='note', description='note', user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + generate_access_token(user))
+        NoteCache(user.id).clear()
+        self.client.get(ENDPOINT_NOTE_LIST)
+        self.client.get(ENDPOINT_NOTE_LIST)
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        with self.settings(METRICS_TOKEN='scrape-token'):
+            response = APIClient().get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong-token')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            response = APIClient().get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn('api_requests_total{route="notes-list",method="GET",status="200"} 2', body)
+        self.assertIn('api_request_duration_seconds_count{route="notes-list",method="GET"} 2', body)
+        self.assertIn('api_db_queries_count{route="notes-list"} 2', body)
+        self.assertIn('api_response_size_bytes_bucket{route="notes-list",le="+Inf"} 2', body)
+        self.assertIn('api_cache_requests_total{cache="notes",result="miss"} 1', body)
+        self.assertIn('api_cache_requests_total{cache="notes-rendered",result="miss"} 1', body)
+        self.assertIn('api_cache_requests_total{cache="notes-rendered",result="hit"} 1', body)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    async def test_async_route_queries_are_counted(self):
+        """
+        Test the metrics count the queries async views run in sync_to_async threads
+        """
+        metrics.reset()
+        user = await sync_to_async(create_user)(username="user1", email="user@email.com", password="password")
+        token = await sync_to_async(generate_access_token)(user)
+        await sync_to_async(Label.objects.create)(title="label 1", color="red", author=user)
+        response = await AsyncClient().get(reverse('async-labels-list'), AUTHORIZATION='Bearer ' + token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        queries = [
+            line for line in metrics.render().splitlines()
+            if line.startswith('api_db_queries_sum{route="async-labels-list"}')
+        ]
+        self.assertEqual(len(queries), 1)
+        self.assertGreater(float(queries[0].split()[-1]), 0)
+
+
+class TestCacheCodecs(TestCase):
+    def test_cache_codecs_read_every_encoding(self):
+        """
+        Test cached values round trip whatever serializer or compression wrote them
+        """
+        data = {'id': 1, 'title': 'ü' * 10, 'description': 'long ' * 200, 'labels': [1, 2], 'color': None}
+        reader = CacheCodec(MsgpackSerializer)
+        for codec in (CacheCodec(MsgpackSerializer), CacheCodec(MsgpackSerializer, 100),
+                      CacheCodec(PickleSerializer), CacheCodec(PickleSerializer, 100)):
+            self.assertEqual(reader.loads(codec.dumps(data)), data)
+        self.assertEqual(reader.loads(pickle.dumps(data)), data)
+        self.assertLess(len(CacheCodec(MsgpackSerializer, 100).dumps(data)), len(pickle.dumps(data)) // 10)
+
+        user = create_user(username="user1", email="user@email.com", password="password")
+        Note.objects.create(title='note', description='long ' * 200, user=user)
+        stdout = StringIO()
+        call_command('cache_size', stdout=stdout)
+        self.assertIn('1 users, 1 notes', stdout.getvalue())
+        self.assertRegex(stdout.getvalue(), r'msgpack\+zlib\s+\d+')
+
+
+class TestLocalCache(TestCase):
+    def setUp(self) -> None:
+        self.client = APIClient()
+
+    def test_local_cache_tier_is_invalidated_by_writes(self):
+        """
+        Test notes and labels are served in process until a write or an invalidation message
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        note = Note.objects.create(title='note', description='note', user=user)
+        Label.objects.create(title='label', color='red', author=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + generate_access_token(user))
+        endpoint = f'{ENDPOINT_NOTE_LIST}{note.id}/'
+        NoteCache(user.id).clear()
+        self.addCleanup(local_cache.close)
+
+        with self.settings(LOCAL_CACHE_MAX_ITEMS=100), \
+                mock.patch.object(NoteCache, 'read', autospec=True, side_effect=NoteCache.read) as read:
+            self.client.get(endpoint)
+            self.assertEqual(self.client.get(endpoint).data['data']['title'], 'note')
+            self.assertEqual(read.call_count, 1)
+            self.client.get(ENDPOINT_LABEL_LIST)
+            with self.assertNumQueries(0):
+                self.assertEqual(len(self.client.get(ENDPOINT_LABEL_LIST).data['data']), 1)
+
+            self.client.put(endpoint, {'title': 'changed', 'description': 'note', 'user': user.id}, format='json')
+            self.assertEqual(self.client.get(endpoint).data['data']['title'], 'changed')
+            self.assertEqual(read.call_count, 2)
+
+            # a write in another process reaches this one over pub/sub
+            get_redis_connection().publish(INVALIDATION_CHANNEL, user.id)
+            for _ in range(50):
+                if local_cache.get('notes', user.id) is None:
+                    break
+                time.sleep(0.1)
+            self.client.get(endpoint)
+            self.assertEqual(read.call_count, 3)
+        self.assertIn('api_cache_requests_total{cache="notes-local",result="hit"}', metrics.render())
+
+    def test_local_cache_tracks_users_only_with_their_entries(self):
+        """
+        Test loading many users evicts the oldest ones instead of dropping the whole tier
+        """
+        self.addCleanup(local_cache.close)
+        with self.settings(LOCAL_CACHE_MAX_ITEMS=4), mock.patch.object(local_cache, 'listen', return_value=True):
+            local_cache.clear()
+            for user_id in range(10):
+                local_cache.get_or_load('notes', user_id, lambda: [user_id], weight=lambda value: 0)
+            self.assertEqual(list(local_cache.generations), [6, 7, 8, 9])
+            self.assertEqual(local_cache.get('notes', 9), [9])
+            self.assertIsNone(local_cache.get('notes', 5))
+
+            # a load started before its user was dropped and tracked again is not kept
+            generation = local_cache.generation(1)
+            local_cache.forget(1)
+            local_cache.generation(1)
+            local_cache.set('notes', 1, ['stale'], generation)
+            self.assertIsNone(local_cache.get('notes', 1))
+
+
+@skipUnless(len(settings.NOTE_SHARDS) > 1, 'needs settings with several NOTE_SHARDS, see core.test_settings')
+class TestSharding(TestCase):
+    databases = {'default', *settings.NOTE_SHARDS}
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_notes_and_labels_live_on_the_shard_of_their_user(self):
+        """
+        Test the API reads and writes the shard of the user and rebalance_user moves the user
+        """
+        source, target = settings.NOTE_SHARDS[:2]
+        user = create_user(username="user1", email="user@email.com", password="password")
+        self.assertEqual(UserShard.objects.get(user=user).shard, assign_shard(user.id))
+        UserShard.objects.filter(user=user).update(shard=source)
+        cache.delete(shard_cache_key(user.id))
+        NoteCache(user.id).clear()
+
+        client = APIClient()
+        login_res = client.post(ENDPOINT_LOGIN, {"email": "user@email.com", "password": "password"})
+        client.credentials(HTTP_AUTHORIZATION='Bearer ' + login_res.data['access'])
+
+        label_id = client.post(ENDPOINT_LABEL_LIST, {'title': "label 1", 'color': "red"}, format='json').data['data']['id']
+        response = client.post(
+            ENDPOINT_NOTE_LIST, {'title': "note 1", 'description': "description", 'labels': [label_id]}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        note_id = response.data['data']['id']
+        response = client.post(ENDPOINT_NOTE_LIST, {'title': "note 2", 'description': "description"}, format='json')
+        client.delete(f"{ENDPOINT_NOTE_LIST}{response.data['data']['id']}/")
+
+        # a write slipping past the lock aborts the move and removes the copies
+        copy = RebalanceCommand.copy
+
+        def write_during_copy(model, instances, using):
+            copy(model, instances, using)
+            if model is Tombstone:
+                Note.objects.using(source).create(title="late", description="description", user_id=user.id)
+
+        with mock.patch.object(RebalanceCommand, 'copy', side_effect=write_during_copy), \
+                self.assertRaises(CommandError):
+            call_command('rebalance_user', user.id, target, '--wait', '0', stdout=StringIO())
+        self.assertEqual(shard_for_user(user.id), source)
+        self.assertFalse(Note.objects.using(target).filter(user_id=user.id).exists())
+        self.assertFalse(Label.objects.using(target).filter(author_id=user.id).exists())
+        late = Note.objects.using(source).get(title="late")
+        Note.objects.using(source).filter(pk=late.id).delete()
+        Tombstone.objects.using(source).filter(object_id=late.id).delete()
+
+        # writes are refused during the move, reads go on
+        cache.set(moving_cache_key(user.id), target)
+        response = client.post(ENDPOINT_NOTE_LIST, {'title': "note 3", 'description': "description"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(client.get(ENDPOINT_NOTE_LIST).status_code, status.HTTP_200_OK)
+        cache.delete(moving_cache_key(user.id))
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(using=source, execute=True):
+            call_command('rebalance_user', user.id, target, '--wait', '0', stdout=out)
+        self.assertIn('1 notes', out.getvalue())
+        self.assertIsNone(cache.get(moving_cache_key(user.id)))
+        self.assertEqual(shard_for_user(user.id), target)
+        self.assertFalse(Note.objects.using(source).filter(user_id=user.id).exists())
+        self.assertFalse(Tombstone.objects.using(source).filter(user_id=user.id).exists())
+        note = Note.objects.using(target).get(pk=note_id)
+        self.assertEqual(list(note.labels.values_list('pk', flat=True)), [label_id])
+        self.assertEqual(Tombstone.objects.using(target).filter(user_id=user.id).count(), 1)
+
+        # the API follows the user to the new shard
+        response = client.get(ENDPOINT_NOTE_LIST, format='json')
+        self.assertEqual([item['title'] for item in response.json()['data']], ["note 1"])
+        payload = {'operations': [
+            {'action': 'create', 'data': {'title': "note 3", 'description': "description", 'labels': [label_id]}},
+            {'action': 'color', 'id': note_id, 'data': {'color': "red"}},
+        ]}
+        response = client.post(reverse('notes-bulk'), payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # new rows take ids from the range of the target shard, disjoint from the moved ones
+        first_id = settings.NOTE_SHARD_ID_RANGE * settings.NOTE_SHARDS.index(target)
+        self.assertGreaterEqual(response.data['data']['created'][0]['id'], first_id)
+        self.assertEqual(Note.objects.for_user(user.id).count(), 2)
+        self.assertEqual(client.delete(f'{ENDPOINT_LABEL_LIST}{label_id}/').status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Tombstone.objects.using(target).filter(user_id=user.id).count(), 2)
+        self.assertFalse(Note.objects.using(source).exists())
+        NoteCache(user.id).clear()
+
+
+@skipUnless('replica1' in settings.DATABASES, 'needs a database alias replica1 mirroring default, see core.test_settings')
+@override_settings(DATABASE_REPLICAS={'default': ('replica1',)})
+class TestReplicas(TransactionTestCase):
+    databases = {'default', 'replica1', *settings.NOTE_SHARDS} & set(settings.DATABASES)
+
+    def tearDown(self):
+        replica_lags.clear()
+
+    @FakeRedis("api.cache.get_redis_connection")
+    @mock.patch('api.replicas.get_redis_connection', get_fake_redis)
+    def test_reads_go_to_a_replica_unless_the_user_wrote_or_it_lags(self):
+        """
+        Test read-only views and note cache rebuilds read the replica, except after a write of the user or on lag
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        # the replica mirrors default, keep the notes of the user there
+        UserShard.objects.filter(user=user).update(shard='default')
+        cache.delete(shard_cache_key(user.id))
+        NoteCache(user.id).clear()
+        client = APIClient()
+        login_res = client.post(ENDPOINT_LOGIN, {"email": "user@email.com", "password": "password"})
+        client.credentials(HTTP_AUTHORIZATION='Bearer ' + login_res.data['access'])
+
+        def replica_queries(endpoint):
+            with CaptureQueriesContext(connections['replica1']) as queries:
+                response = client.get(endpoint, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return len(queries)
+
+        response = client.post(ENDPOINT_LABEL_LIST, {'title': "label 1", 'color': "red"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        Note.objects.create(title="note 1", description="description", user=user)
+        # read your writes
+        self.assertEqual(replica_queries(ENDPOINT_LABEL_LIST), 0)
+
+        get_fake_redis().delete(pin_key(user.id))
+        self.assertGreater(replica_queries(ENDPOINT_LABEL_LIST), 0)
+        self.assertGreater(replica_queries(ENDPOINT_NOTE_LIST), 0)
+
+        NoteCache(user.id).clear()
+        with mock.patch('api.replicas.measure_lag', return_value=settings.REPLICA_MAX_LAG + 1.0):
+            replica_lags.clear()
+            self.assertEqual(replica_queries(ENDPOINT_NOTE_LIST), 0)
+            self.assertEqual(replica_queries(f'{ENDPOINT_LABEL_LIST}{response.data["data"]["id"]}/'), 0)
+        NoteCache(user.id).clear()
+
+
+class TestThrottling(TestCase):
+    rates = {'auth-ip': '3/hour', 'auth-account': '2/hour', 'note-write-ip': '10/min', 'note-write-user': '1/min'}
+
+    def setUp(self):
+        client = get_fake_redis()
+        for key in client.scan_iter('throttle:*'):
+            client.delete(key)
+
+    @mock.patch('api.throttling.get_redis_connection', get_fake_redis)
+    def test_auth_actions_are_throttled_per_account_and_ip(self):
+        """
+        Test the email sending auth actions take tokens per email address and per IP and send Retry-After
+        """
+        for i in range(3):
+            create_user(username=f"user{i}", email=f"user{i}@email.com", password="password")
+        client = APIClient()
+        endpoint = reverse('auth-forget-password')
+        with self.settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': self.rates}), \
+                mock.patch('api.tasks.task_drain_email_outbox.delay') as drain, \
+                self.captureOnCommitCallbacks(execute=True):
+            for _ in range(2):
+                self.assertEqual(client.post(endpoint, {'email': "user0@email.com"}).status_code, status.HTTP_200_OK)
+            response = client.post(endpoint, {'email': "USER0@email.com"})
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(int(response['Retry-After']), 1800)
+
+            # the refused request took no token from the IP bucket
+            self.assertEqual(client.post(endpoint, {'email': "user1@email.com"}).status_code, status.HTTP_200_OK)
+            response = client.post(endpoint, {'email': "user2@email.com"})
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(int(response['Retry-After']), 1200)
+        self.assertEqual(drain.call_count, 3)
+        self.assertEqual(EmailOutbox.objects.filter(kind=EmailOutbox.FORGET_PASSWORD).count(), 3)
+
+    @FakeRedis("api.cache.get_redis_connection")
+    def test_note_writes_are_throttled_per_user(self):
+        """
+        Test note writes take a token of the user while reads are not throttled
+        """
+        user = create_user(username="user1", email="user@email.com", password="password")
+        NoteCache(user.id).clear()
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Bearer ' + generate_access_token(user))
+        payload = {'title': "test note 001", "description": "test description 001"}
+        # fakeredis keeps loaded scripts per connection, Redis per server
+        redis = get_fake_redis()
+        with self.settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': self.rates}), \
+                mock.patch('api.throttling.get_redis_connection', return_value=redis), \
+                mock.patch('redis.Redis.script_load', autospec=True, side_effect=Redis.script_load) as load:
+            self.assertEqual(client.post(ENDPOINT_NOTE_LIST, payload).status_code, status.HTTP_201_CREATED)
+            response = client.post(ENDPOINT_NOTE_LIST, payload)
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(int(response['Retry-After']), 60)
+            for _ in range(3):
+                self.assertEqual(client.get(ENDPOINT_NOTE_LIST).status_code, status.HTTP_200_OK)
+        # the script is loaded once on the server, later requests run it by its hash
+        self.assertEqual([call.args[1] for call in load.call_args_list].count(TOKEN_BUCKET_LUA.encode()), 1)
+        self.assertEqual(Note.objects.filter(user=user).count(), 1)
+        NoteCache(user.id).clear()
+
+
+class TestCacheWarmer(TransactionTestCase):
+    @FakeRedis("api.cache.get_redis_connection")
+    @mock.patch('api.management.commands.warm_note_cache.get_redis_connection', get_fake_redis)
+    def test_note_caches_are_warmed_in_parallel_chunks_and_resumed(self):
+        """
+        Test warm_note_cache builds the caches of every user from chunked queries and continues after its cursor
+        """
+        users = [create_user(username=f"user{i}", email=f"user{i}@email.com", password="password") for i in range(3)]
+        label = Label.objects.create(title="label 1", color="red", author=users[1])
+        for user in users[1:]:
+            for i in range(2):
+                Note.objects.create(title=f"note {i}", description="description", user=user).labels.add(label)
+        for user in users:
+            self.addCleanup(NoteCache(user.id).clear)
+            NoteCache(user.id).clear()
+
+        out = StringIO()
+        call_command('warm_note_cache', '--chunk-size', '2', '--workers', '2', '--restart', stdout=out)
+        self.assertIn('warmed 3 users, 4 notes', out.getvalue())
+        self.assertIsNone(get_fake_redis().get(CURSOR_KEY))
+        for user in users:
+            note_cache = NoteCache(user.id)
+            expected = note_cache.build(note_cache.get_queryset())
+            with self.assertNumQueries(0):
+                self.assertEqual(note_cache.read(), expected)
+
+        # an interrupted run continues after the last chunk done
+        for user in users:
+            NoteCache(user.id).clear()
+        get_fake_redis().set(CURSOR_KEY, users[0].id)
+        out = StringIO()
+        call_command('warm_note_cache', '--missing-only', stdout=out)
+        self.assertIn(f'resuming after user {users[0].id}', out.getvalue())
+        self.assertIn('warmed 2 users, 4 notes', out.getvalue())
+        self.assertFalse(get_fake_redis().hexists(NoteCache(users[0].id).key, NoteCache.sentinel))
+
+    @FakeRedis("api.cache.get_redis_connection")
+    @mock.patch('api.management.commands.warm_note_cache.get_redis_connection', get_fake_redis)
+    def test_only_users_logged_in_recently_are_warmed(self):
+        """
+        Test logging in records last_login and warm_note_cache --active-days only warms those users
+        """
+        users = [create_user(username=f"user{i}", email=f"user{i}@email.com", password="password") for i in range(2)]
+        for user in users:
+            Note.objects.create(title="note", description="description", user=user)
+            self.addCleanup(NoteCache(user.id).clear)
+            NoteCache(user.id).clear()
+        response = APIClient().post(ENDPOINT_LOGIN, {"email": "user1@email.com", "password": "password"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        out = StringIO()
+        call_command('warm_note_cache', '--active-days', '1', '--restart', stdout=out)
+        self.assertIn('warmed 1 users, 1 notes', out.getvalue())
+        self.assertFalse(get_fake_redis().hexists(NoteCache(users[0].id).key, NoteCache.sentinel))
+        self.assertTrue(get_fake_redis().hexists(NoteCache(users[1].id).key, NoteCache.sentinel))
+
+
+class TestEmailTasks(TestCase):
+    @FakeRedis("api.tasks.get_redis_connection")
+    def test_queued_emails_are_sent_in_batches_over_one_connection(self):
+        """
+        Test email tasks queue messages and the drain sends them over one connection
+        """
+        with mock.patch('api.tasks.task_send_pending_emails.apply_async') as schedule, \
+                mock.patch('api.tasks.task_send_pending_emails.delay'):
+            for user_id in range(5):
+                task_send_verify_user_email(user_id, f"user{user_id}@email.com")
+        schedule.assert_called_once()
+        self.assertEqual(len(mail.outbox), 0)
+
+        with self.settings(EMAIL_BATCH_SIZE=2), mock.patch('api.tasks.get_connection', wraps=get_connection) as opened:
+            self.assertEqual(task_send_pending_emails(), 5)
+        opened.assert_called_once()
+        self.assertEqual([message.to for message in mail.outbox], [[f"user{i}@email.com"] for i in range(5)])
+        self.assertEqual(get_fake_redis().llen(EMAIL_QUEUE_KEY), 0)
+
+        with mock.patch('api.tasks.get_connection') as opened:
+            self.assertEqual(task_send_pending_emails(), 0)
+        opened.assert_not_called()
+
+    @FakeRedis("api.tasks.get_redis_connection")
+    def test_failed_send_keeps_the_batch_and_retries_the_drain(self):
+        """
+        Test a failed SMTP send puts the batch back and schedules another drain
+        """
+        with mock.patch('api.tasks.task_send_pending_emails.apply_async'):
+            task_send_verify_user_email(1, "user1@email.com")
+        failure = ConnectionError('smtp down')
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=failure), \
+                mock.patch('api.tasks.task_send_pending_emails.retry', side_effect=Retry()) as retry:
+            with self.assertRaises(Retry):
+                task_send_pending_emails()
+        retry.assert_called_once_with(exc=failure, countdown=settings.EMAIL_BATCH_LATENCY)
+        self.assertEqual(get_fake_redis().llen(EMAIL_QUEUE_KEY), 1)
+
+        self.assertEqual(task_send_pending_emails(), 1)
+        self.assertEqual([message.to for message in mail.outbox], [["user1@email.com"]])
+
+    @FakeRedis("api.tasks.get_redis_connection")
+    def test_failed_send_requeues_only_the_messages_not_sent(self):
+        """
+        Test a send failing partway through a batch does not send the delivered messages twice
+        """
+        with mock.patch('api.tasks.task_send_pending_emails.apply_async'):
+            for user_id in range(3):
+                task_send_verify_user_email(user_id, f"user{user_id}@email.com")
+        send_messages = EmailBackend.send_messages
+        failure = ConnectionError('smtp down')
+
+        def fail_second(backend, messages):
+            if messages[0].to == ["user1@email.com"]:
+                raise failure
+            return send_messages(backend, messages)
+
+        with mock.patch.object(EmailBackend, 'send_messages', fail_second), \
+                mock.patch('api.tasks.task_send_pending_emails.retry', side_effect=Retry()):
+            with self.assertRaises(Retry):
+                task_send_pending_emails()
+        self.assertEqual([message.to for message in mail.outbox], [["user0@email.com"]])
+        self.assertEqual(get_fake_redis().llen(EMAIL_QUEUE_KEY), 2)
+
+        self.assertEqual(task_send_pending_emails(), 2)
+        self.assertEqual([message.to for message in mail.outbox], [[f"user{i}@email.com"] for i in range(3)])
+
+    @FakeRedis("api.tasks.get_redis_connection")
+    def test_registration_writes_the_outbox_drained_after_commit(self):
+        """
+        Test a new user gets an outbox row in its transaction and the drain queues it
+        """
+        with mock.patch('api.tasks.task_send_pending_emails.apply_async') as schedule, \
+                mock.patch('api.tasks.task_drain_email_outbox.delay') as drain:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = APIClient().post(
+                    reverse('auth-register'),
+                    {"username": "user1", "email": "user@email.com", "password": "password"},
+                )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            drain.assert_called_once_with()
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(ValueError), transaction.atomic():
+                    create_user(username="user2", email="rolled@email.com", password="password")
+                    raise ValueError('rollback')
+            drain.assert_called_once_with()
+            self.assertEqual(list(EmailOutbox.objects.values_list('email', flat=True)), ["user@email.com"])
+            schedule.assert_not_called()
+
+            self.assertEqual(task_drain_email_outbox(), 1)
+        schedule.assert_called_once()
+        self.assertFalse(EmailOutbox.objects.exists())
+        self.assertEqual(get_fake_redis().llen(EMAIL_QUEUE_KEY), 1)
+
+    def test_users_are_imported_in_bulk_with_outbox_rows(self):
+        """
+        Test import_users hashes passwords in worker processes, skips taken emails and writes the outbox in bulk
+        """
+        create_user(username="user0", email="user0@email.com", password="password")
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            writer = csv.writer(f)
+            writer.writerow(['email', 'username', 'password', 'is_verified'])
+            writer.writerow(['user0@email.com', 'user0', 'password', ''])
+            writer.writerow(['user1@EMAIL.com', 'user1', 'secret1', 'true'])
+            writer.writerow(['user1@email.com', 'user1', 'secret1', 'true'])
+            writer.writerow(['user2@email.com', 'user2', '', ''])
+            writer.writerow(['', 'nobody', 'secret', ''])
+        self.addCleanup(os.remove, f.name)
+
+        out = StringIO()
+        with mock.patch('api.tasks.task_send_pending_emails.delay'):
+            call_command('import_users', f.name, '--workers', '2', '--chunk-size', '2', '--send-verification', stdout=out)
+        self.assertIn('5 read, 2 created, 2 existing, 1 skipped', out.getvalue())
+        first, second = User.objects.filter(username__in=["user1", "user2"]).order_by('username')
+        self.assertTrue(first.check_password("secret1"))
+        self.assertTrue(first.is_verified)
+        self.assertFalse(second.has_usable_password())
+        self.assertEqual(
+            sorted(EmailOutbox.objects.filter(user__in=[first, second]).values_list('email', flat=True)),
+            ["user1@email.com", "user2@email.com"],
+        )
+
+    def test_import_continues_after_a_chunk_of_skipped_rows(self):
+        """
+        Test import_users reads past a chunk where every row is skipped
+        """
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            writer = csv.writer(f)
+            writer.writerow(['email', 'username', 'password'])
+            writer.writerow(['a1@email.com', 'a1', 'secret'])
+            writer.writerow(['', 'a2', 'secret'])
+            writer.writerow(['a3@email.com', 'a3', 'secret'])
+        self.addCleanup(os.remove, f.name)
+
+        out = StringIO()
+        call_command('import_users', f.name, '--workers', '1', '--chunk-size', '1', stdout=out)
+        self.assertIn('3 read, 2 created, 0 existing, 1 skipped', out.getvalue())
+        self.assertEqual(sorted(User.objects.values_list('username', flat=True)), ['a1', 'a3'])
@@ -0,0 +1,115 @@
+"""
+Token bucket throttles kept in Redis. A bucket rated 'n/period' holds up to
+n tokens and regains n tokens per period; a request takes one token from
+each of its buckets, per client IP and per account, or is refused with the
+seconds until all of them hold a token again. One Lua script checks and
+draws every bucket of a request atomically, in a single round trip.
+"""
+import logging
+
+from django_redis import get_redis_connection
+from redis.commands.core import Script
+from redis.exceptions import RedisError
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# KEYS: buckets, ARGV: capacity and tokens per second of each bucket.
+# Returns the seconds to wait as a string, "0" when the tokens were taken.
+TOKEN_BUCKET_LUA = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity, rate = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    local bucket = redis.call('HMGET', key, 'tokens', 'at')
+    local available = tonumber(bucket[1]) or capacity
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    tokens[i] = math.min(capacity, available + elapsed * rate)
+    if tokens[i] < 1 then
+        wait = math.max(wait, (1 - tokens[i]) / rate)
+    end
+end
+if wait == 0 then
+    for i, key in ipairs(KEYS) do
+        local capacity, rate = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+        redis.call('HSET', key, 'tokens', tokens[i] - 1, 'at', now)
+        redis.call('EXPIRE', key, math.ceil(capacity / rate))
+    end
+end
+return tostring(wait)
+"""
+# hashed once, run with EVALSHA on the client of each call and loaded on a server missing it
+token_bucket = Script(None, TOKEN_BUCKET_LUA.encode())
+
+
+def parse_rate(rate):
+    """Return the capacity and the tokens per second of a 'n/period' rate"""
+    num, period = rate.split('/')
+    return int(num), int(num) / PERIODS[period[0]]
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttle on the buckets returned by ``get_buckets()`` as (scope, ident)
+    pairs, rated by the scopes of DEFAULT_THROTTLE_RATES. Requests are let
+    through when the default cache is not a reachable Redis.
+    """
+    key_prefix = 'throttle'
+
+    def __init__(self):
+        self.retry_after = None
+
+    def get_buckets(self, request, view):
+        raise NotImplementedError('.get_buckets() must be overridden')
+
+    def allow_request(self, request, view):
+        keys, args = [], []
+        for scope, ident in self.get_buckets(request, view):
+            if ident is None:
+                continue
+            keys.append(f'{self.key_prefix}:{scope}:{ident}')
+            args.extend(parse_rate(api_settings.DEFAULT_THROTTLE_RATES[scope]))
+        if not keys:
+            return True
+        try:
+            client = get_redis_connection()
+            self.retry_after = float(token_bucket(keys=keys, args=args, client=client))
+        except NotImplementedError:
+            # the default cache is not Redis
+            return True
+        except RedisError as e:
+            logger.exception(e)
+            return True
+        return self.retry_after == 0
+
+    def wait(self):
+        return self.retry_after
+
+
+class AuthThrottle(TokenBucketThrottle):
+    """Limit the auth actions sending emails per client IP and per email address"""
+
+    def get_buckets(self, request, view):
+        email = request.data.get('email') if hasattr(request.data, 'get') else None
+        return [
+            ('auth-ip', self.get_ident(request)),
+            ('auth-account', email.strip().lower() if isinstance(email, str) and email.strip() else None),
+        ]
+
+
+class NoteWriteThrottle(TokenBucketThrottle):
+    """Limit the note writes per client IP and per user, reads are not throttled"""
+
+    def get_buckets(self, request, view):
+        if request.method in SAFE_METHODS:
+            return []
+        return [
+            ('note-write-ip', self.get_ident(request)),
+            ('note-write-user', request.user.id if request.user.is_authenticated else None),
+        ]
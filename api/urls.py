@@ -1,6 +1,7 @@
+from django.urls import path
 from rest_framework.routers import DefaultRouter
 
-from api import views
+from api import async_views, views
 
 router = DefaultRouter()
 
@@ -11,4 +12,10 @@ router.register('note-archive', viewset=views.NoteArchivedViewSet, basename='arc
 router.register('update-color', viewset=views.NoteUpdateColorViewSet, basename='archive')
 router.register('user', viewset=views.UserViewSet, basename='users')
 
-urlpatterns = router.urls
+urlpatterns = router.urls + [
+    path('async/note/', async_views.AsyncNoteListView.as_view(), name='async-notes-list'),
+    path('async/note/<int:pk>/', async_views.AsyncNoteDetailView.as_view(), name='async-notes-detail'),
+    path('async/label/', async_views.AsyncLabelListView.as_view(), name='async-labels-list'),
+    path('async/label/<int:pk>/', async_views.AsyncLabelDetailView.as_view(), name='async-labels-detail'),
+    path('metrics/', views.metrics_view, name='metrics'),
+]
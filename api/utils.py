@@ -26,10 +26,63 @@ def generate_jwt_token(user_id):
     return str(token)
 
 
-def ReturnResponse(message="", data=None, status_code=status.HTTP_200_OK):
+def str_to_bool(value):
+    """Parse an optional boolean query parameter"""
+    if value is None:
+        return None
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    raise ValueError(f'invalid boolean value: {value}')
+
+
+def note_list_filters(params):
+    """Read the note listing filters from query parameters"""
+    return {
+        'archived': str_to_bool(params.get('archived')),
+        'label': None if params.get('label') is None else int(params['label']),
+        'color': params.get('color'),
+    }
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def parse_sync_cursor(value):
+    """Read a delta sync cursor, microseconds since the epoch, None asks for everything"""
+    if not value:
+        return None
+    return EPOCH + timedelta(microseconds=int(value))
+
+
+def make_sync_cursor(moment):
+    return str((moment - EPOCH) // timedelta(microseconds=1))
+
+
+def user_cache_key(user_id):
+    return f'auth-user:{user_id}'
+
+
+def ReturnResponse(message="", data=None, status_code=status.HTTP_200_OK, **extra):
     if not data:
         data = {}
     return Response(
-        {'status': status_code, 'message': message, 'data': data},
+        {'status': status_code, 'message': message, 'data': data, **extra},
         status_code
     )
+
+
+class RenderedResponse(Response):
+    """Response sending a body rendered beforehand, finalized by the view like any other response"""
+
+    def __init__(self, body, **kwargs):
+        super().__init__(**kwargs)
+        self.body = body
+
+    @property
+    def rendered_content(self):
+        renderer = self.accepted_renderer
+        charset = f'; charset={renderer.charset}' if renderer.charset else ''
+        self['Content-Type'] = f'{renderer.media_type}{charset}'
+        return self.body
@@ -1,40 +1,85 @@
 import logging
-
-from django.core.cache import cache
-from django.forms.models import model_to_dict
+import re
+from collections import defaultdict
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import transaction
+from django.db.models import F
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.http import parse_etags
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import status
 from rest_framework import viewsets
+from rest_framework.authentication import get_authorization_header
 from rest_framework.decorators import action
-from rest_framework.permissions import AllowAny, IsAdminUser
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
 from rest_framework.reverse import reverse
 
 from api.authentication import JWTAuthentication
-from api.models import Label, Note, User
+from api.cache import DataVersion, NoteCache
+from api.local_cache import local_cache
+from api.metrics import metrics
+from api.models import (
+    EmailOutbox, Label, Note, NoteLabel, Tombstone, User, bulk_tombstones, drain_email_outbox_on_commit
+)
+from api.ndjson import Importer, export_user_data
+from api.replicas import replica_reads, replica_view
 from api.serializers import (
     LabelSerializer, NoteSerializer, UserSerializer,
-    NoteArchivedSerializer, NoteUpdateColorSerializer
+    NoteArchivedSerializer, NoteUpdateColorSerializer, NoteBulkSerializer
+)
+from api.sharding import ShardWritable, shard_for_user
+from api.tasks import task_send_verify_user_email
+from api.throttling import AuthThrottle, NoteWriteThrottle
+from api.utils import (
+    decode_jwt_token, ReturnResponse, RenderedResponse, generate_jwt_token, str_to_bool, note_list_filters,
+    parse_sync_cursor, make_sync_cursor
 )
-from api.tasks import task_send_verify_user_email, task_send_forget_password_email
-from api.utils import decode_jwt_token, ReturnResponse, generate_jwt_token
 
 logger = logging.getLogger(__name__)
 
 
+def version_etag(view_func):
+    """
+    Tag responses with the user's data version and answer a matching
+    If-None-Match with 304. The view reads the version as request.data_version.
+    """
+    @wraps(view_func)
+    def wrapper(self, request, *args, **kwargs):
+        request.data_version = DataVersion(request.user.id).get()
+        etag = f'"{request.data_version}"'
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        response = view_func(self, request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            response['ETag'] = etag
+        return response
+    return wrapper
+
+
 # Create your views here.
 class AuthorisationViewSet(viewsets.ViewSet):
     permission_classes = (AllowAny,)
     http_method_names = ['post']
 
     @swagger_auto_schema(request_body=UserSerializer)
-    @action(detail=False, methods=['post'])
+    @action(detail=False, methods=['post'], throttle_classes=[AuthThrottle])
     def register(self, request):
         try:
             serializer = UserSerializer(data=request.data)
             if serializer.is_valid(raise_exception=True):
-                serializer.save()
+                # the verification email is written to the outbox in the same transaction
+                with transaction.atomic():
+                    serializer.save()
                 return ReturnResponse(data=serializer.data, status_code=status.HTTP_201_CREATED)
             return ReturnResponse(data=serializer.errors, status_code=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
@@ -44,7 +89,7 @@ class AuthorisationViewSet(viewsets.ViewSet):
     @swagger_auto_schema(manual_parameters=[
         openapi.Parameter('email', openapi.TYPE_STRING, type=openapi.TYPE_STRING, required=True), ],
         responses={200: 'message sent'}, )
-    @action(detail=False, methods=['post'])
+    @action(detail=False, methods=['post'], throttle_classes=[AuthThrottle])
     def send_verification_email(self, request):
         email = request.data.get('email')
         user = get_object_or_404(User, email=email)
@@ -60,13 +105,15 @@ class AuthorisationViewSet(viewsets.ViewSet):
     @swagger_auto_schema(manual_parameters=[
         openapi.Parameter('email', openapi.TYPE_STRING, type=openapi.TYPE_STRING, required=True), ],
         responses={200: 'message sent'}, )
-    @action(detail=False, methods=['post'])
+    @action(detail=False, methods=['post'], throttle_classes=[AuthThrottle])
     def forget_password(self, request):
         try:
             user = get_object_or_404(User, email=request.data.get('email'))
             print(reverse("auth-update-password"))
             print(str(generate_jwt_token(user.id)))
-            task_send_forget_password_email.delay(user.id, user.email)
+            with transaction.atomic():
+                EmailOutbox.objects.create(kind=EmailOutbox.FORGET_PASSWORD, user=user, email=user.email)
+                drain_email_outbox_on_commit()
             return ReturnResponse(status_code=status.HTTP_200_OK, message='message sent')
         except Exception as e:
             logger.exception(e)
@@ -110,14 +157,16 @@ class UserViewSet(viewsets.ModelViewSet):
     http_method_names = ['get']
     queryset = User.objects.all()
 
+    @replica_view
     def list(self, request, *args, **kwargs):
         try:
-            serializer = self.get_serializer(self.get_queryset(), many=True)
-            return ReturnResponse(data=serializer.data, status_code=200)
+            page = self.paginator.paginate_values(self.get_queryset(), request, self.get_serializer_class())
+            return self.get_paginated_response(page)
         except Exception as e:
             logger.exception(e)
             return ReturnResponse(message=str(e), status_code=400)
 
+    @replica_view
     def retrieve(self, request, *args, **kwargs):
         try:
             serializer = self.get_serializer(self.get_queryset().get(pk=kwargs.get('pk')))
@@ -129,27 +178,24 @@ class UserViewSet(viewsets.ModelViewSet):
 
 class NoteArchivedViewSet(viewsets.ModelViewSet):
     authentication_classes = (JWTAuthentication,)
+    throttle_classes = (NoteWriteThrottle,)
+    permission_classes = (IsAuthenticated, ShardWritable)
     serializer_class = NoteArchivedSerializer
     http_method_names = ['put']
 
     def get_queryset(self):
         user = self.request.user
-        queryset = Note.objects.filter(user__id=user.id)
+        queryset = Note.objects.for_user(user.id)
         return queryset
 
-    def update_cache(self, user_id):
-        """Update cached memory"""
-        json_data = [{item.id: model_to_dict(item)} for item in self.get_queryset()]
-        cache.set(user_id, json_data)
-
     def update(self, request, *args, **kwargs):
         try:
             pk = kwargs.get('pk')
-            note = get_object_or_404(Note, pk=pk)
+            note = get_object_or_404(self.get_queryset(), pk=pk)
             serializer = self.get_serializer(note, data=request.data)
             if serializer.is_valid(raise_exception=True):
-                serializer.save()
-                self.update_cache(request.user.id)
+                note = serializer.save()
+                NoteCache(note.user_id).set(note)
                 return ReturnResponse(data=serializer.data, status_code=status.HTTP_200_OK)
             return ReturnResponse(data=serializer.errors, status_code=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
@@ -159,27 +205,24 @@ class NoteArchivedViewSet(viewsets.ModelViewSet):
 
 class NoteUpdateColorViewSet(viewsets.ModelViewSet):
     authentication_classes = (JWTAuthentication,)
+    throttle_classes = (NoteWriteThrottle,)
+    permission_classes = (IsAuthenticated, ShardWritable)
     serializer_class = NoteUpdateColorSerializer
     http_method_names = ['put']
 
     def get_queryset(self):
         user = self.request.user
-        queryset = Note.objects.filter(user__id=user.id)
+        queryset = Note.objects.for_user(user.id)
         return queryset
 
-    def update_cache(self, user_id):
-        """Update cached memory"""
-        json_data = [{item.id: model_to_dict(item)} for item in self.get_queryset()]
-        cache.set(user_id, json_data)
-
     def update(self, request, *args, **kwargs):
         try:
             pk = kwargs.get('pk')
-            note = get_object_or_404(Note, pk=pk)
+            note = get_object_or_404(self.get_queryset(), pk=pk)
             serializer = self.get_serializer(note, data=request.data)
             if serializer.is_valid(raise_exception=True):
-                serializer.save()
-                self.update_cache(request.user.id)
+                note = serializer.save()
+                NoteCache(note.user_id).set(note)
                 return ReturnResponse(data=serializer.data, status_code=status.HTTP_200_OK)
             return ReturnResponse(data=serializer.errors, status_code=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
@@ -189,36 +232,58 @@ class NoteUpdateColorViewSet(viewsets.ModelViewSet):
 
 class NoteViewSet(viewsets.ModelViewSet):
     authentication_classes = (JWTAuthentication,)
+    throttle_classes = (NoteWriteThrottle,)
+    permission_classes = (IsAuthenticated, ShardWritable)
     serializer_class = NoteSerializer
 
     def get_queryset(self):
         user = self.request.user
-        queryset = Note.objects.filter(user__id=user.id)
+        queryset = Note.objects.for_user(user.id)
         return queryset
 
-    def update_cache(self, user_id):
-        """Update cached memory"""
-        json_data = [{item.id: model_to_dict(item)} for item in self.get_queryset()]
-        cache.set(user_id, json_data)
-
+    @version_etag
     def list(self, request, *args, **kwargs):
+        """
+        List notes from the note cache. JSON bodies are cached rendered, keyed
+        by data version and the parameters the page depends on, and sent back
+        as they are while no note of the user changes.
+        """
         try:
-            dataset = cache.get(request.user.id)
-            if dataset:
-                data = [v for item in dataset for k, v in item.items()]
-                return ReturnResponse(data=data)
-            return ReturnResponse(message="No data found", status_code=status.HTTP_204_NO_CONTENT)
+            filters = note_list_filters(request.query_params)
+            note_cache = NoteCache(request.user.id)
+            renderer = request.accepted_renderer
+            rendered = isinstance(renderer, JSONRenderer)
+            if rendered:
+                field = self.rendered_field(request, filters)
+                body = note_cache.get_rendered(field)
+                if body is not None:
+                    return RenderedResponse(body)
+            data = self.paginator.paginate_cache(note_cache, request, **filters)
+            if not data:
+                return ReturnResponse(message="No data found", status_code=status.HTTP_204_NO_CONTENT)
+            response = self.get_paginated_response(data)
+            if not rendered:
+                return response
+            body = renderer.render(response.data, request.accepted_media_type, self.get_renderer_context())
+            note_cache.set_rendered(field, body)
+            return RenderedResponse(body)
         except Exception as e:
             logger.exception(e)
             return ReturnResponse(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
 
+    def rendered_field(self, request, filters):
+        """Cache field of a rendered page, other query parameters do not change the page"""
+        return ':'.join(str(part) for part in (
+            request.data_version, request.accepted_media_type, request.scheme, request.get_host(),
+            *filters.values(), self.paginator.get_page_size(request),
+            request.query_params.get(self.paginator.cursor_query_param),
+        ))
+
     def retrieve(self, request, *args, **kwargs):
         try:
             pk = kwargs.get('pk')
-            cached_data = list(cache.get(request.user.id))
-            if cached_data:
-                dataset = list(filter(None, [i.get(int(pk)) for i in cached_data]))
-                data = {} if len(dataset) == 0 else dataset[0]
+            data = NoteCache(request.user.id).get(int(pk))
+            if data is not None:
                 return ReturnResponse(data=data)
             return ReturnResponse(status_code=status.HTTP_404_NOT_FOUND)
         except Exception as e:
@@ -231,8 +296,8 @@ class NoteViewSet(viewsets.ModelViewSet):
             data.update({'user': request.user.id})
             serializer = self.get_serializer(data=data)
             if serializer.is_valid(raise_exception=True):
-                serializer.save()
-                self.update_cache(request.user.id)
+                note = serializer.save()
+                NoteCache(note.user_id).set(note)
                 return ReturnResponse(data=serializer.data, status_code=status.HTTP_201_CREATED)
             return ReturnResponse(data=serializer.errors, status_code=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
@@ -242,11 +307,11 @@ class NoteViewSet(viewsets.ModelViewSet):
     def update(self, request, *args, **kwargs):
         try:
             pk = kwargs.get('pk')
-            note = get_object_or_404(Note, pk=pk)
+            note = get_object_or_404(self.get_queryset(), pk=pk)
             serializer = self.get_serializer(note, data=request.data)
             if serializer.is_valid(raise_exception=True):
-                serializer.save()
-                self.update_cache(request.user.id)
+                note = serializer.save()
+                NoteCache(note.user_id).set(note)
                 return ReturnResponse(data=serializer.data, status_code=status.HTTP_200_OK)
             return ReturnResponse(data=serializer.errors, status_code=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
@@ -256,35 +321,204 @@ class NoteViewSet(viewsets.ModelViewSet):
     def destroy(self, request, *args, **kwargs):
         try:
             pk = kwargs.get('pk')
-            note = get_object_or_404(Note, pk=pk)
+            note = get_object_or_404(self.get_queryset(), pk=pk)
             note.delete()
-            self.update_cache(request.user.id)
+            NoteCache(note.user_id).delete(pk)
             return ReturnResponse(message='Delete successful', status_code=status.HTTP_204_NO_CONTENT)
         except Exception as e:
             logger.exception(e)
             return ReturnResponse(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
 
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('q', openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True), ])
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """Full text search over title and description, every word matched as a prefix, best matches first"""
+        try:
+            terms = re.findall(r'\w+', request.query_params.get('q', ''))
+            if not terms:
+                raise ValueError('search text is required')
+            query = SearchQuery(' & '.join(f'{term}:*' for term in terms), search_type='raw', config='english')
+            queryset = self.get_queryset().filter(search_vector=query).annotate(
+                rank=SearchRank(F('search_vector'), query)
+            ).order_by('-rank', 'pk').prefetch_related('labels')
+            notes = queryset[:self.paginator.get_page_size(request)]
+            if notes:
+                serializer = self.get_serializer(notes, many=True)
+                return ReturnResponse(data=serializer.data)
+            return ReturnResponse(message="No data found", status_code=status.HTTP_204_NO_CONTENT)
+        except Exception as e:
+            logger.exception(e)
+            return ReturnResponse(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('since', openapi.IN_QUERY, type=openapi.TYPE_STRING, required=False), ])
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        """
+        Notes and labels changed and ids deleted after the ``since`` cursor,
+        with the cursor to send next time. Without a cursor, or with one older
+        than the kept tombstones, everything is sent and ``reset`` is set.
+        """
+        try:
+            now = timezone.now()
+            since = parse_sync_cursor(request.query_params.get('since'))
+            reset = since is None or since < now - timedelta(days=settings.SYNC_TOMBSTONE_DAYS)
+            note_cache = NoteCache(request.user.id)
+            notes = note_cache.get_queryset().order_by('pk')
+            labels = Label.objects.for_user(request.user.id).order_by('pk')
+            deleted = {Tombstone.NOTE: [], Tombstone.LABEL: []}
+            if not reset:
+                notes = notes.filter(updated_at__gt=since)
+                labels = labels.filter(updated_at__gt=since)
+                tombstones = Tombstone.objects.for_user(request.user.id).filter(deleted_at__gt=since)
+                for kind, object_id in tombstones.order_by('pk').values_list('kind', 'object_id'):
+                    deleted[kind].append(object_id)
+            data = {
+                'notes': [note_cache.to_dict(note) for note in notes],
+                'labels': LabelSerializer.values(labels),
+                'deleted': {'notes': deleted[Tombstone.NOTE], 'labels': deleted[Tombstone.LABEL]},
+                'reset': reset,
+                'cursor': make_sync_cursor(now - timedelta(seconds=settings.SYNC_CURSOR_OVERLAP)),
+            }
+            return ReturnResponse(data=data)
+        except Exception as e:
+            logger.exception(e)
+            return ReturnResponse(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """Stream all labels and notes of the user as NDJSON, one object per line, labels first"""
+        with replica_reads(request.user.id):
+            body = export_user_data(request.user.id)
+        response = StreamingHttpResponse(body, content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="notes-{request.user.id}.ndjson"'
+        return response
+
+    @action(detail=False, methods=['post'], url_path='import', url_name='import')
+    def import_data(self, request):
+        """
+        Add the labels and notes of an NDJSON body in the export format to the
+        user's data. The body is read line by line and inserted in chunks in
+        one transaction; the note cache is rebuilt once at the end.
+        """
+        try:
+            lines = iter(request.stream.readline, b'') if request.stream is not None else ()
+            return ReturnResponse(data=Importer(request.user.id).run(lines), status_code=status.HTTP_201_CREATED)
+        except Exception as e:
+            logger.exception(e)
+            return ReturnResponse(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+
+    @swagger_auto_schema(request_body=NoteBulkSerializer)
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """Apply a batch of create, update, archive, color and delete operations in one transaction"""
+        try:
+            serializer = NoteBulkSerializer(data=request.data, context={'request': request})
+            serializer.is_valid(raise_exception=True)
+            operations = serializer.validated_data['operations']
+
+            ids = {op['id'] for op in operations if op['action'] != 'create'}
+            notes = self.get_queryset().in_bulk(ids)
+            missing = ids.difference(notes)
+            if missing:
+                raise ValueError(f'notes not found: {sorted(missing)}')
+
+            created, updated, deleted, fields = [], {}, set(), defaultdict(set)
+            now = timezone.now()
+            created_labels, updated_labels = [], {}
+            for op in operations:
+                labels = op['data'].pop('labels', None)
+                if op['action'] == 'create':
+                    note = Note(user=request.user, **op['data'])
+                    created.append(note)
+                    created_labels.append((note, labels or []))
+                elif op['action'] == 'delete':
+                    updated.pop(op['id'], None)
+                    fields.pop(op['id'], None)
+                    updated_labels.pop(op['id'], None)
+                    deleted.add(op['id'])
+                elif op['id'] in deleted:
+                    raise ValueError(f"note {op['id']} is deleted earlier in this batch")
+                else:
+                    note = notes[op['id']]
+                    for field, value in op['data'].items():
+                        setattr(note, field, value)
+                    # bulk_update skips auto_now, label changes count as a change of the note too
+                    note.updated_at = now
+                    fields[note.id].update(op['data'], ['updated_at'])
+                    updated[note.id] = note
+                    if labels is not None:
+                        updated_labels[note.id] = labels
+
+            shard = shard_for_user(request.user.id)
+            with transaction.atomic(using=shard):
+                created = Note.objects.using(shard).bulk_create(created)
+                # every note writes only the fields sent for it, a concurrent change of the others is kept
+                batches = defaultdict(list)
+                for note_id, note in updated.items():
+                    batches[frozenset(fields[note_id])].append(note)
+                for names, batch in batches.items():
+                    Note.objects.using(shard).bulk_update(batch, sorted(names))
+                if deleted:
+                    # one insert for the tombstones of all the deleted notes
+                    with bulk_tombstones(shard):
+                        Note.objects.using(shard).filter(pk__in=deleted).delete()
+                if updated_labels:
+                    NoteLabel.objects.using(shard).filter(note_id__in=updated_labels).delete()
+                note_labels = [(note.id, labels) for note, labels in created_labels] + list(updated_labels.items())
+                NoteLabel.objects.using(shard).bulk_create(
+                    [NoteLabel(note_id=note_id, label=label) for note_id, labels in note_labels for label in labels]
+                )
+
+            created_ids = {note.id for note in created}
+            changed = NoteCache(request.user.id).refresh(created_ids.union(updated), deleted=deleted)
+            data = {
+                'created': NoteSerializer([note for note in changed if note.id in created_ids], many=True).data,
+                'updated': NoteSerializer([note for note in changed if note.id in updated], many=True).data,
+                'deleted': sorted(deleted),
+            }
+            return ReturnResponse(data=data, status_code=status.HTTP_200_OK)
+        except Exception as e:
+            logger.exception(e)
+            return ReturnResponse(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+
 
 class LabelViewSet(viewsets.ModelViewSet):
     authentication_classes = (JWTAuthentication,)
+    permission_classes = (IsAuthenticated, ShardWritable)
     serializer_class = LabelSerializer
 
     def get_queryset(self):
         user = self.request.user
-        queryset = Label.objects.filter(author__id=user.id)
+        queryset = Label.objects.for_user(user.id)
         return queryset
 
+    @version_etag
+    @replica_view
     def list(self, request, *args, **kwargs):
         try:
-            data = self.get_queryset()
-            if data.exists():
-                serializer = self.get_serializer(data, many=True)
-                return ReturnResponse(data=serializer.data)
+            queryset = self.get_queryset()
+            archived = str_to_bool(request.query_params.get('archived'))
+            if local_cache.enabled:
+                labels = local_cache.get_or_load(
+                    'labels', request.user.id, lambda: LabelSerializer.values(queryset.order_by('pk'))
+                )
+                if archived is not None:
+                    labels = [label for label in labels if label['is_archived'] == archived]
+                page = self.paginator.paginate_rows(labels, request)
+            else:
+                if archived is not None:
+                    queryset = queryset.filter(is_archived=archived)
+                page = self.paginator.paginate_values(queryset, request, self.get_serializer_class())
+            if page:
+                return self.get_paginated_response(page)
             return ReturnResponse(message="No data found", status_code=status.HTTP_204_NO_CONTENT)
         except Exception as e:
             logger.exception(e)
             return ReturnResponse(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
 
+    @replica_view
     def retrieve(self, request, *args, **kwargs):
         try:
             qs = self.get_queryset().get(pk=kwargs.get('pk'))
@@ -295,11 +529,10 @@ class LabelViewSet(viewsets.ModelViewSet):
 
     def create(self, request, *args, **kwargs):
         try:
-            data = request.data.copy()
-            data.update({'author': request.user.id})
-            serializer = self.get_serializer(data=data)
+            serializer = self.get_serializer(data=request.data)
             if serializer.is_valid(raise_exception=True):
-                serializer.save()
+                serializer.save(author=request.user)
+                DataVersion(request.user.id).bump()
                 return ReturnResponse(data=serializer.data, status_code=status.HTTP_201_CREATED)
             return ReturnResponse(data=serializer.errors, status_code=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
@@ -312,6 +545,7 @@ class LabelViewSet(viewsets.ModelViewSet):
             serializer = self.get_serializer(qs, data=request.data)
             if serializer.is_valid(raise_exception=True):
                 serializer.save()
+                DataVersion(request.user.id).bump()
                 return ReturnResponse(data=serializer.data, status_code=status.HTTP_200_OK)
             return ReturnResponse(data=serializer.errors, status_code=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
@@ -322,9 +556,21 @@ class LabelViewSet(viewsets.ModelViewSet):
         try:
             qs = self.get_queryset().get(pk=kwargs.get('pk'))
             if qs:
+                note_ids = list(qs.note.values_list('id', flat=True))
                 qs.delete()
+                NoteCache(request.user.id).refresh(note_ids)
                 return ReturnResponse(status_code=status.HTTP_204_NO_CONTENT)
             return ReturnResponse(status_code=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             logger.exception(e)
             return ReturnResponse(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+
+
+def metrics_view(request):
+    """Expose the metrics of this worker in the Prometheus text format to the bearer of METRICS_TOKEN"""
+    header = get_authorization_header(request).split()
+    token = settings.METRICS_TOKEN
+    if not token or len(header) != 2 or header[0].lower() != b'bearer' \
+            or not constant_time_compare(header[1], token.encode()):
+        return HttpResponse(status=status.HTTP_403_FORBIDDEN)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -2,8 +2,6 @@ import os
 from datetime import timedelta
 from pathlib import Path
 
-from drf_yasg import openapi
-
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 # Quick-start development settings - unsuitable for production
@@ -25,6 +23,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework_simplejwt',
     'drf_yasg',
@@ -32,6 +31,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     "corsheaders.middleware.CorsMiddleware",
@@ -76,6 +76,22 @@ DATABASES = {
     }
 }
 
+# aliases of DATABASES holding the notes and labels of the users, new users are spread by id.
+# every alias gets the whole schema; migrate starts the ids of the i-th alias at i * NOTE_SHARD_ID_RANGE.
+# with several aliases notes and labels have no foreign key to their user: moving from one alias to several,
+# run `migrate api 0011` then `migrate` on every alias to drop them
+NOTE_SHARDS = ('default',)
+NOTE_SHARD_ID_RANGE = 10 ** 12
+DATABASE_ROUTERS = ['api.sharding.UserShardRouter', 'api.replicas.ReplicaRouter']
+
+# replica aliases of DATABASES aliases, e.g. {'default': ('default-replica',)}. Read-only views and note cache
+# rebuilds read a replica at most REPLICA_MAX_LAG seconds behind, checked every REPLICA_LAG_CHECK_INTERVAL
+# seconds, except for users who wrote in the last REPLICA_PIN_SECONDS; keep it above REPLICA_MAX_LAG
+DATABASE_REPLICAS = {}
+REPLICA_MAX_LAG = 2
+REPLICA_LAG_CHECK_INTERVAL = 5
+REPLICA_PIN_SECONDS = 10
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -121,6 +137,30 @@ EMAIL_PORT = 587
 EMAIL_HOST_USER = 'test.shuvam@gmail.com'
 EMAIL_HOST_PASSWORD = 'gxworetdbjjtqeif'
 EMAIL_USE_TLS = True
+# queued emails are sent in batches over one connection, a batch waits at most EMAIL_BATCH_LATENCY seconds
+EMAIL_BATCH_SIZE = 50
+EMAIL_BATCH_LATENCY = 2
+# a failed send is retried after EMAIL_BATCH_LATENCY seconds, doubled on every failure up to this
+EMAIL_RETRY_MAX_DELAY = 300
+# the email outbox is drained when a row commits, pending rows left by a failed drain are moved to the
+# email queue every EMAIL_OUTBOX_DRAIN_INTERVAL seconds
+EMAIL_OUTBOX_DRAIN_INTERVAL = 5
+
+# delta sync: a cursor is moved back by SYNC_CURSOR_OVERLAP seconds to catch writes committed late,
+# tombstones of deleted rows are kept SYNC_TOMBSTONE_DAYS, older cursors get a full resync
+SYNC_CURSOR_OVERLAP = 5
+SYNC_TOMBSTONE_DAYS = 30
+
+CELERY_BEAT_SCHEDULE = {
+    'drain-email-outbox': {
+        'task': 'api.tasks.task_drain_email_outbox',
+        'schedule': EMAIL_OUTBOX_DRAIN_INTERVAL,
+    },
+    'prune-tombstones': {
+        'task': 'api.tasks.task_prune_tombstones',
+        'schedule': 60 * 60 * 24,
+    },
+}
 
 # logging configuration
 LOGGING = {
@@ -156,17 +196,47 @@ AUTH_USER_MODEL = 'api.User'
 
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': ('rest_framework.permissions.IsAuthenticated',),
-    'DEFAULT_AUTHENTICATION _CLASSES': ('api.authentication.JWTAuthentication',)
+    'DEFAULT_AUTHENTICATION _CLASSES': ('api.authentication.JWTAuthentication',),
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.KeysetPagination',
+    'PAGE_SIZE': 50,
+    'DEFAULT_RENDERER_CLASSES': (
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    # token buckets of api.throttling: a 'n/period' bucket bursts up to n requests and refills n per period
+    'DEFAULT_THROTTLE_RATES': {
+        'auth-ip': '20/hour',
+        'auth-account': '5/hour',
+        'note-write-ip': '600/min',
+        'note-write-user': '120/min',
+    },
 }
 
 JWT_EXP_TIME = 60 * 60
 
+# encoding of the note cache values, values of NOTE_CACHE_COMPRESS_MIN_SIZE bytes or more are zlib compressed
+NOTE_CACHE_SERIALIZER = 'api.cache_serializers.MsgpackSerializer'
+NOTE_CACHE_COMPRESS_MIN_SIZE = 256
+
+# in-process tier in front of the note cache and label lists, up to LOCAL_CACHE_MAX_ITEMS notes and labels
+# in total, 0 disables it. Entries are invalidated over Redis pub/sub and live at most LOCAL_CACHE_TTL seconds
+LOCAL_CACHE_MAX_ITEMS = 0
+LOCAL_CACHE_TTL = 60
+
+# verified tokens kept in process, authenticated users kept in redis for given seconds
+AUTH_TOKEN_CACHE_SIZE = 1024
+AUTH_USER_CACHE_TIMEOUT = 60
+
+# bearer token the Prometheus scraper sends to the metrics endpoint, the endpoint refuses every request while unset
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
     'ROTATE_REFRESH_TOKENS': False,
     'BLACKLIST_AFTER_ROTATION': False,
-    'UPDATE_LAST_LOGIN': False,
+    # last_login selects the users of warm_note_cache --active-days
+    'UPDATE_LAST_LOGIN': True,
 
     'ALGORITHM': 'HS256',
     'SIGNING_KEY': SECRET_KEY,
@@ -194,14 +264,7 @@ SIMPLE_JWT = {
 }
 
 SWAGGER_SETTINGS = {
-    'DEFAULT_INFO': openapi.Info(
-        title="Fun-to-do Note",
-        default_version='v3',
-        description="Test description",
-        terms_of_service="https://www.google.com/policies/terms/",
-        contact=openapi.Contact(email="contact@snippets.local"),
-        license=openapi.License(name="BSD License"),
-    ),
+    'DEFAULT_INFO': 'core.urls.api_info',
     'SECURITY_DEFINITIONS': {
         'Bearer': {
             'type': 'apiKey',
@@ -0,0 +1,14 @@
+"""
+Settings of the sharding and replica tests: a second note shard and a
+replica mirroring default on the database server of core.settings.
+`make test` runs those tests with them after the rest of the suite.
+"""
+from core.settings import *  # noqa: F401,F403
+from core.settings import DATABASES
+
+DATABASES = {
+    **DATABASES,
+    'shard1': {**DATABASES['default'], 'NAME': f"{DATABASES['default']['NAME']}_shard1"},
+    'replica1': {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}},
+}
+NOTE_SHARDS = ('default', 'shard1')
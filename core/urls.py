@@ -1,11 +1,21 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import TemplateView
+from drf_yasg import openapi
 from drf_yasg.views import get_schema_view
 from rest_framework.permissions import AllowAny
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView, TokenVerifyView
 from . import views
 
+api_info = openapi.Info(
+    title="Fun-to-do Note",
+    default_version='v3',
+    description="Test description",
+    terms_of_service="https://www.google.com/policies/terms/",
+    contact=openapi.Contact(email="contact@snippets.local"),
+    license=openapi.License(name="BSD License"),
+)
+
 schema_view = get_schema_view(public=True, permission_classes=(AllowAny,))
 
 urlpatterns = [